@@ -0,0 +1,199 @@
+from __future__ import absolute_import, print_function
+
+import gc
+import sys
+import argparse
+import logging
+
+from nebel import engine
+from nebel import dbus as nebeldbus
+from nebel import notifications as notify
+from nebel.notifier import notifier
+from nebel.trace import ReplayBus
+from nebel.udisks import *
+
+# memory regression check for objects that come and go
+#
+# Drives a DiskMonitor through rounds of simulated jobs,
+# devices and drives as if UDisks2 announced them, with an
+# in-process notification daemon behind the real client.
+# After every round the tables and the live instances must
+# be back where they were once the warm-up is over. It takes
+# two rounds, and with notifications that never expire it
+# lasts until the bounded table of notification ids is full.
+#
+#   python -m bench.churn [--rounds N] [--jobs N] [--devices N] [--expire MS]
+#                         [--engine glib|asyncio]
+#
+# The system bus is a replay bus without recorded replies,
+# so nothing outside the process is needed. The calls nebel
+# makes for the made-up objects fail and are ignored.
+
+CHURN_PATH_JOBS = UDISKS_PATH + "/jobs/churn"
+CHURN_PATH_DEVICES = UDISKS_PATH_DEVICES + "/churn"
+CHURN_PATH_DRIVE = UDISKS_PATH_DRIVES + "/churn"
+
+# unique name of the notification daemon
+DAEMON_NAME = ":churn.1"
+
+# a notification daemon that closes what it shows after a while
+class Daemon:
+    def __init__(self, expire):
+        self.expire = expire
+        self.last_id = 0
+        self.shown = 0
+        self.closed = None
+
+    def add_signal_receiver(self, handler, signal_name=None, **kwargs):
+        if signal_name == "NotificationClosed":
+            self.closed = handler
+
+    def call_async(self, dest, path, iface, method, signature, args,
+                   reply, error, timeout=None):
+        if method == "Notify":
+            id = args[1]
+            if not id:
+                self.last_id += 1
+                id = self.last_id
+            self.shown += 1
+            engine.idle_add(self.notified, reply, id)
+        elif method == "GetCapabilities":
+            engine.idle_add(self.reply, reply, ["body"])
+        elif method == "GetNameOwner":
+            engine.idle_add(self.reply, reply, DAEMON_NAME)
+        else:
+            engine.idle_add(self.reply, reply)
+
+    def reply(self, reply, *ret):
+        reply(*ret)
+        return False
+
+    # like on the bus, an id is closed only after its reply
+    def notified(self, reply, id):
+        reply(id)
+        if self.expire >= 0:
+            engine.timeout_add(self.expire, self.close, id)
+        return False
+
+    def close(self, id):
+        self.closed(id, 1, sender=DAEMON_NAME)
+        return False
+
+# ignores what the real UDisks2 has
+class ChurnMonitor(DiskMonitor):
+    def enumerate(self):
+        pass
+
+def churn(monitor, round, jobs, devices):
+    drive = "%s%d" % (CHURN_PATH_DRIVE, round)
+    monitor.ifs_added(drive, {UDISKS_DRIVE: {
+        "Vendor": "Churn", "Model": "Drive %d" % round,
+        "Removable": True, "MediaRemovable": True, "MediaAvailable": True}})
+    for i in range(devices):
+        path = "%s%d_%d" % (CHURN_PATH_DEVICES, round, i)
+        monitor.ifs_added(path, {
+            UDISKS_BLOCK: {"Device": "/dev/churn%d" % i, "Drive": drive},
+            UDISKS_FILESYSTEM: {},
+        })
+        for j in range(jobs // max(devices, 1)):
+            job = "%s%d_%d_%d" % (CHURN_PATH_JOBS, round, i, j)
+            monitor.ifs_added(job, {UDISKS_JOB: {
+                "Operation": OPERATION_FS_MOUNT, "Objects": [path],
+                "Progress": 0.0, "ProgressValid": True, "Bytes": 1000000}})
+            monitor.jobs[job].props_changed(UDISKS_JOB, {"Progress": 0.5}, [])
+            monitor.jobs[job].completed(True, "")
+            monitor.ifs_removed(job, [UDISKS_JOB])
+        # one at a time, the device lives on with the other one
+        monitor.ifs_removed(path, [UDISKS_FILESYSTEM])
+        monitor.ifs_removed(path, [UDISKS_BLOCK])
+    monitor.ifs_removed(drive, [UDISKS_DRIVE])
+
+# runs the main loop until the notifier is idle and ms after
+def settle(ms):
+    loop = engine.main_loop()
+    def idle():
+        if notifier.pending:
+            return True
+        engine.timeout_add(ms, loop.quit)
+        return False
+    engine.timeout_add(10, idle)
+    loop.run()
+
+def live(*classes):
+    gc.collect()
+    counts = dict()
+    for cls in classes:
+        counts[cls.__name__] = 0
+    for obj in gc.get_objects():
+        for cls in classes:
+            if isinstance(obj, cls):
+                counts[cls.__name__] += 1
+    return counts
+
+def measure(monitor):
+    counts = live(DiskJob, DiskDevice, DiskDrive, notify.Notification)
+    counts["objs"] = len(monitor.objs)
+    counts["jobs"] = len(monitor.jobs)
+    counts["devices"] = len(monitor.devices)
+    counts["drives"] = len(monitor.drives)
+    counts["pending"] = len(monitor.pending)
+    counts["routes"] = len(nebeldbus.router.routes)
+    counts["notifier"] = len(notifier.pending)
+    counts["ids"] = len(notify.client.ids)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Check for memory growth under object churn")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--jobs", type=int, default=1000)
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--expire", type=int, default=0,
+                        help="close notifications after MS, -1 never")
+    parser.add_argument("--settle", type=int, default=None,
+                        help="time for the main loop after each round in MS, "
+                        "counted from when the notifier is idle")
+    parser.add_argument("--engine", choices=engine.ENGINES, default="glib")
+    args = parser.parse_args()
+    settle_ms = args.settle
+    if settle_ms == None:
+        settle_ms = 200
+        if args.expire > 0:
+            settle_ms += args.expire
+
+    logging.basicConfig(level=logging.ERROR)
+    engine.use(args.engine)
+    nebeldbus.connect(ReplayBus())
+    daemon = Daemon(args.expire)
+    notify.client = notify.NotificationClient(daemon, "nebel-churn")
+    for lane in notifier.lanes.values():
+        lane.rate = None
+
+    monitor = ChurnMonitor()
+    baseline = None
+    keys = None
+    for round in range(args.rounds):
+        churn(monitor, round, args.jobs, args.devices)
+        settle(settle_ms)
+        counts = measure(monitor)
+        if keys == None:
+            keys = sorted(counts.keys())
+            print(" ".join(["%6s" % "round"] + ["%8s" % key[:8] for key in keys]))
+        # notifications that never expire stay in the id table
+        # until it is full, and keep their objects alive
+        filling = args.expire < 0 and len(notify.client.ids) < notify.client.max_ids
+        warmup = round <= 1 or filling
+        if warmup:
+            baseline = counts
+        print(" ".join(["%6d" % round] + ["%8d" % counts[key] for key in keys]))
+    print("%d notifications shown" % daemon.shown)
+    if warmup:
+        print("still warming up after %d rounds" % args.rounds)
+        sys.exit(1)
+
+    grown = [key for key in keys if counts[key] > baseline[key]]
+    if grown:
+        print("grown since the warm-up: %s" % ", ".join(grown))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,593 @@
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from nebel import engine
+from nebel.engine import clock
+from nebel import dbus as nebeldbus
+from nebel import notifications as notify
+from nebel.notifier import notifier
+from nebel.udisks import DiskMonitor, UDISKS, UDISKS_BLOCK, UDISKS_DRIVE, \
+    UDISKS_FILESYSTEM, UDISKS_PATH, UDISKS_PATH_DEVICES, UDISKS_PATH_DRIVES
+from nebel.upower import PowerMonitor, UPOWER, UPOWER_DEVICE, UPOWER_PATH
+from nebel.urfkill import RfkillMonitor, URFKILL, URFKILL_DEVICE, URFKILL_PATH
+
+# time from a system event to its notification
+#
+# Starts a private dbus-daemon with fake UDisks2, UPower,
+# URfkill and notification services in this process, and
+# drives the monitors with scripted workloads. Each workload
+# runs in a process of its own and reports its startup time,
+# the latency from emitting a signal to the Notify call that
+# reports it, the calls nebel makes per event and the peak
+# RSS of the process, fakes included.
+#
+#   python -m bench.latency [--workloads startup,hotplug,battery,rfkill]
+#                           [--engines glib,asyncio]
+#
+# The fakes run on the same engine as nebel, on connections
+# of their own, so each engine is measured end to end.
+#
+# Notifications go through the real notifier, so its rate
+# limits are part of the numbers, --unthrottled lifts them.
+
+DBUS_PROPERTIES = nebeldbus.DBUS_PROPERTIES
+DBUS_OBJECT_MANAGER = nebeldbus.DBUS_OBJECT_MANAGER
+DBUS_PEER = "org.freedesktop.DBus.Peer"
+
+BUS_CONFIG = """<!DOCTYPE busconfig PUBLIC "-//freedesktop//DTD D-Bus Bus Configuration 1.0//EN"
+ "http://www.freedesktop.org/standards/dbus/1.0/busconfig.dtd">
+<busconfig>
+  <type>session</type>
+  <listen>unix:dir=%s</listen>
+  <auth>EXTERNAL</auth>
+  <policy context="default">
+    <allow send_destination="*" eavesdrop="true"/>
+    <allow eavesdrop="true"/>
+    <allow own="*"/>
+  </policy>
+</busconfig>
+"""
+
+# limits for waiting on nebel in seconds
+STARTUP_TIMEOUT = 60.0
+SETTLE_TIMEOUT = 120.0
+
+# time for calls still on the wire after the notifier is idle
+SETTLE_GRACE = 0.1
+
+WORKLOADS = ("startup", "hotplug", "battery", "rfkill")
+
+class PrivateBus(object):
+    def __init__(self, daemon):
+        self.dir = tempfile.mkdtemp(prefix="nebel-bench-")
+        config = os.path.join(self.dir, "bus.conf")
+        with open(config, "w") as f:
+            f.write(BUS_CONFIG % self.dir)
+        self.process = subprocess.Popen(
+            [daemon, "--config-file", config, "--print-address", "--nofork"],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        self.address = self.process.stdout.readline().strip()
+
+    def connect(self):
+        return engine.open_bus(self.address)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+# a service on a connection of its own
+#
+# Method calls go to the object at their path, which has
+# them in METHODS as {(interface, member): (method name,
+# reply signature)}.
+class FakeService(object):
+    def __init__(self, bus, name):
+        self.conn = bus.connect()
+        self.name = name
+        self.objects = dict()
+        self.calls = 0
+        self.named = False
+        engine.export(self.conn, name, self.handle, self.ready)
+
+    def ready(self):
+        self.named = True
+
+    def handle(self, path, iface, member, args):
+        if iface == DBUS_PEER and member == "Ping":
+            return "", ()
+        obj = self.objects.get(str(path))
+        if obj == None or not (iface, member) in obj.METHODS:
+            return None
+        method, signature = obj.METHODS[(iface, member)]
+        ret = getattr(obj, method)(*args)
+        if signature == "":
+            return "", ()
+        return signature, (ret,)
+
+    def emit(self, path, iface, member, signature, *args):
+        engine.emit(self.conn, path, iface, member, signature, args)
+
+# an object with properties, as {interface: {name: variant}}
+class FakeObject(object):
+    METHODS = {
+        (DBUS_PROPERTIES, "GetAll"): ("get_all", "a{sv}"),
+        (DBUS_PROPERTIES, "Get"): ("get", "v"),
+    }
+
+    def __init__(self, service, path, props):
+        self.service = service
+        self.path = path
+        self.props = props
+        service.objects[path] = self
+
+    def get_all(self, iface):
+        self.service.calls += 1
+        return self.props.get(iface, {})
+
+    def get(self, iface, name):
+        self.service.calls += 1
+        return self.props[iface][name]
+
+    def change(self, iface, changed):
+        self.props[iface].update(changed)
+        self.service.emit(self.path, DBUS_PROPERTIES, "PropertiesChanged", "sa{sv}as",
+                          iface, changed, [])
+
+class FakeObjectManager(FakeObject):
+    METHODS = {
+        (DBUS_OBJECT_MANAGER, "GetManagedObjects"): ("get_managed_objects", "a{oa{sa{sv}}}"),
+    }
+
+    def __init__(self, service, path):
+        FakeObject.__init__(self, service, path, {})
+        self.objects = dict()
+
+    def get_managed_objects(self):
+        self.service.calls += 1
+        objs = dict()
+        for path, obj in self.objects.items():
+            objs[path] = obj.props
+        return objs
+
+    def add(self, path, props, emit=True):
+        self.objects[path] = FakeObject(self.service, path, props)
+        if emit:
+            self.service.emit(self.path, DBUS_OBJECT_MANAGER, "InterfacesAdded", "oa{sa{sv}}",
+                              path, props)
+
+class FakeUDisks(FakeService):
+    def __init__(self, bus):
+        FakeService.__init__(self, bus, UDISKS)
+        self.manager = FakeObjectManager(self, UDISKS_PATH)
+
+    def add_drive(self, name, removable, emit=True):
+        v = engine.variant
+        path = "%s/%s" % (UDISKS_PATH_DRIVES, name)
+        self.manager.add(path, {UDISKS_DRIVE: {
+            "Vendor": v("s", "Bench"), "Model": v("s", name), "Serial": v("s", name),
+            "Removable": v("b", removable), "Ejectable": v("b", removable),
+            "MediaRemovable": v("b", False), "MediaAvailable": v("b", True),
+            "Size": v("t", 1 << 30)}}, emit)
+        return path
+
+    def add_device(self, name, drive, emit=True):
+        v = engine.variant
+        path = "%s/%s" % (UDISKS_PATH_DEVICES, name)
+        self.manager.add(path, {
+            UDISKS_BLOCK: {"Device": v("ay", b"/dev/" + name.encode("ascii") + b"\0"),
+                           "Drive": v("o", drive), "IdType": v("s", "ext4")},
+            UDISKS_FILESYSTEM: {}}, emit)
+        return path
+
+# the root of UPower and URfkill, which list their devices
+class FakeEnumerator(FakeObject):
+    def __init__(self, service, path, iface, props):
+        FakeObject.__init__(self, service, path, props)
+        self.iface = iface
+        self.devices = list()
+        self.METHODS = dict(FakeObject.METHODS)
+        self.METHODS[(iface, "EnumerateDevices")] = ("enumerate_devices", "ao")
+
+    def enumerate_devices(self):
+        self.service.calls += 1
+        return self.devices
+
+    def device_changed(self, path):
+        self.service.emit(self.path, self.iface, "DeviceChanged", "o", path)
+
+class FakeUPower(FakeService):
+    def __init__(self, bus):
+        FakeService.__init__(self, bus, UPOWER)
+        self.root = FakeEnumerator(self, UPOWER_PATH, UPOWER,
+                                   {UPOWER: {"OnBattery": engine.variant("b", True)}})
+
+    def add_battery(self, name, percent):
+        v = engine.variant
+        path = "%s/devices/battery_%s" % (UPOWER_PATH, name)
+        obj = FakeObject(self, path, {UPOWER_DEVICE: {
+            "NativePath": v("s", name), "Type": v("u", 2), "PowerSupply": v("b", True),
+            "State": v("u", 2), "Online": v("b", False), "Percentage": v("d", float(percent)),
+            "TimeToEmpty": v("x", 3600), "TimeToFull": v("x", 0)}})
+        self.root.devices.append(path)
+        return obj
+
+class FakeURfkill(FakeService):
+    def __init__(self, bus):
+        FakeService.__init__(self, bus, URFKILL)
+        self.root = FakeEnumerator(self, URFKILL_PATH, URFKILL, {})
+
+    def add_switch(self, index, name):
+        v = engine.variant
+        path = "%s/devices/%d" % (URFKILL_PATH, index)
+        obj = FakeObject(self, path, {URFKILL_DEVICE: {
+            "name": v("s", name), "soft": v("b", False), "hard": v("b", False)}})
+        self.root.devices.append(path)
+        return obj
+
+class FakeNotificationsObject(object):
+    METHODS = {
+        (notify.NOTIFICATIONS, "Notify"): ("notify", "u"),
+        (notify.NOTIFICATIONS, "GetCapabilities"): ("get_capabilities", "as"),
+        (notify.NOTIFICATIONS, "CloseNotification"): ("close_notification", ""),
+    }
+
+    def __init__(self, service):
+        self.service = service
+        service.objects[notify.NOTIFICATIONS_PATH] = self
+
+    def notify(self, app_name, id, icon, summary, body, actions, hints, timeout):
+        return self.service.notified(id, summary, body)
+
+    def get_capabilities(self):
+        return ["body"]
+
+    def close_notification(self, id):
+        pass
+
+class FakeNotifications(FakeService):
+    def __init__(self, bus):
+        FakeService.__init__(self, bus, notify.NOTIFICATIONS)
+        self.object = FakeNotificationsObject(self)
+        self.last_id = 0
+        self.shown = list()
+
+    def notified(self, id, summary, body):
+        self.shown.append((clock(), str(summary), str(body)))
+        if not id:
+            self.last_id += 1
+            id = self.last_id
+        return id
+
+# runs the main loop until predicate holds or timeout seconds passed
+def wait(loop, predicate, timeout):
+    deadline = clock() + timeout
+    def poll():
+        if predicate() or clock() > deadline:
+            loop.quit()
+            return False
+        return True
+    engine.timeout_add(1, poll)
+    loop.run()
+    return predicate()
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+# a scripted run against the fakes
+#
+# setup() creates what the services have before nebel
+# starts and ready() tells when the monitor for SERVICE is
+# done with startup. The monitor is started by a registry
+# like nebel does it, so signals are only taken from the
+# owner of the service. script() returns the events as
+# (delay in seconds, function, text of the notification).
+class Workload(object):
+    def __init__(self, bus, args):
+        self.bus = bus
+        self.args = args
+        self.loop = engine.main_loop()
+        self.services = list()
+        self.emitted = list()
+
+    def calls(self):
+        return sum([service.calls for service in self.services])
+
+    def wait(self, predicate, timeout):
+        return wait(self.loop, predicate, timeout)
+
+    def named(self):
+        return all([service.named for service in self.services])
+
+    def start(self):
+        self.registry = nebeldbus.MonitorRegistry()
+        self.registry.register(self.SERVICE, self.MONITOR)
+        self.registry.start()
+
+    def started(self):
+        self.monitor = self.registry.monitors.get(self.SERVICE)
+        return self.monitor != None and self.ready()
+
+    def settled(self):
+        return (len(self.emitted) == len(self.events) and not notifier.pending
+                and not nebeldbus.caller.pending)
+
+    def emit(self, events):
+        for fn, text in events:
+            fn()
+            self.emitted.append((clock(), text))
+        # the bus keeps the order of messages between two
+        # connections, once the pings are answered nebel has
+        # seen the signals sent before them
+        for service in self.services:
+            nebeldbus.caller.call(service.name, "/", DBUS_PEER, "Ping", "", (), lambda: None)
+        return False
+
+    def run(self, notifications):
+        self.setup()
+        if not self.wait(self.named, STARTUP_TIMEOUT):
+            raise RuntimeError("fake services did not get their names")
+        calls = self.calls()
+        start = clock()
+        self.start()
+        if not self.wait(self.started, STARTUP_TIMEOUT):
+            raise RuntimeError("monitor did not start up")
+        startup = clock() - start
+        startup_calls = self.calls() - calls
+        calls = self.calls()
+
+        self.events = self.script()
+        # events due at the same time are emitted in one go
+        batches = dict()
+        for delay, fn, text in self.events:
+            batches.setdefault(delay, list()).append((fn, text))
+        for delay in sorted(batches.keys()):
+            engine.timeout_add(int(delay * 1000), self.emit, batches[delay])
+        first = len(notifications.shown)
+        if not self.wait(self.settled, SETTLE_TIMEOUT):
+            raise RuntimeError("events did not settle")
+        self.wait(lambda: False, SETTLE_GRACE)
+        calls = self.calls() - calls
+
+        latencies = list()
+        shown = notifications.shown[first:]
+        for stamp, text in self.emitted:
+            if text == None:
+                continue
+            for when, summary, body in shown:
+                if when >= stamp and (text in summary or text in body):
+                    latencies.append(when - stamp)
+                    break
+        events = len(self.events)
+        return {
+            "startup": startup,
+            "startup_calls": startup_calls,
+            "events": events,
+            "notified": len(latencies),
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+            "calls_per_event": float(calls) / events if events else None,
+            "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }
+
+    def initialized(self, objs):
+        return (all([obj.init for obj in objs])
+                and not nebeldbus.caller.pending)
+
+# many block devices on fixed drives at startup
+class StartupWorkload(Workload):
+    SERVICE = UDISKS
+    MONITOR = DiskMonitor
+
+    def setup(self):
+        self.udisks = FakeUDisks(self.bus)
+        self.services.append(self.udisks)
+        drives = list()
+        for i in range(max(self.args.devices // 50, 1)):
+            drives.append(self.udisks.add_drive("fixed%03d" % i, False, emit=False))
+        for i in range(self.args.devices):
+            self.udisks.add_device("sd%04d" % i, drives[i % len(drives)], emit=False)
+
+    def ready(self):
+        return (len(self.monitor.objs) == len(self.udisks.manager.objects)
+                and self.initialized(self.monitor.objs.values()))
+
+    def script(self):
+        return []
+
+# a burst of removable drives plugged in
+class HotplugWorkload(Workload):
+    SERVICE = UDISKS
+    MONITOR = DiskMonitor
+
+    def setup(self):
+        self.udisks = FakeUDisks(self.bus)
+        self.services.append(self.udisks)
+
+    def ready(self):
+        return self.monitor.present and not nebeldbus.caller.pending
+
+    def script(self):
+        events = list()
+        for i in range(self.args.drives):
+            name = "bench%03d" % i
+            events.append((0, lambda name=name: self.plug(name), name))
+        return events
+
+    def plug(self, name):
+        drive = self.udisks.add_drive(name, True)
+        self.udisks.add_device("sd%s" % name, drive)
+
+# a discharging battery reporting its level
+class BatteryWorkload(Workload):
+    SERVICE = UPOWER
+    MONITOR = PowerMonitor
+
+    def setup(self):
+        self.upower = FakeUPower(self.bus)
+        self.services.append(self.upower)
+        self.battery = self.upower.add_battery("BAT0", self.args.battery_start)
+
+    def ready(self):
+        return len(self.monitor.devs) == 1 and self.initialized(self.monitor.devs.values())
+
+    def script(self):
+        events = list()
+        for i in range(self.args.battery_updates):
+            percent = self.args.battery_start - i - 1
+            events.append((i / self.args.battery_rate,
+                           lambda percent=percent: self.battery.change(
+                               UPOWER_DEVICE, {"Percentage": engine.variant("d", float(percent))}),
+                           "BAT0 now at %d%%" % percent))
+        return events
+
+# a radio switch toggled back and forth
+class RfkillWorkload(Workload):
+    SERVICE = URFKILL
+    MONITOR = RfkillMonitor
+
+    def setup(self):
+        self.urfkill = FakeURfkill(self.bus)
+        self.services.append(self.urfkill)
+        self.switch = self.urfkill.add_switch(0, "bench-wlan")
+
+    def ready(self):
+        return len(self.monitor.devs) == 1 and self.initialized(self.monitor.devs.values())
+
+    def script(self):
+        events = list()
+        for i in range(self.args.rfkill_updates):
+            blocked = i % 2 == 0
+            text = "Unblocked radio bench-wlan"
+            if blocked:
+                text = "Blocked radio bench-wlan"
+            events.append((i / self.args.rfkill_rate,
+                           lambda blocked=blocked: self.toggle(blocked), text))
+        return events
+
+    def toggle(self, blocked):
+        self.switch.props[URFKILL_DEVICE]["soft"] = engine.variant("b", blocked)
+        self.urfkill.root.device_changed(self.switch.path)
+
+WORKLOAD_CLASSES = {
+    "startup": StartupWorkload,
+    "hotplug": HotplugWorkload,
+    "battery": BatteryWorkload,
+    "rfkill": RfkillWorkload,
+}
+
+def run_child(name, args):
+    logging.basicConfig(level=logging.ERROR)
+    engine.use(args.engine)
+    bus = PrivateBus(args.dbus_daemon)
+    loop = engine.main_loop()
+    connections = list()
+    try:
+        notifications = FakeNotifications(bus)
+        connections.append(notifications.conn)
+        if not wait(loop, lambda: notifications.named, STARTUP_TIMEOUT):
+            raise RuntimeError("fake notification daemon did not get its name")
+        notify.init("nebel-bench", bus=bus.connect())
+        connections.append(notify.client.bus)
+        connections.append(nebeldbus.connect(bus.connect()))
+        if args.unthrottled:
+            for lane in notifier.lanes.values():
+                lane.rate = None
+        workload = WORKLOAD_CLASSES[name](bus, args)
+        try:
+            result = workload.run(notifications)
+        finally:
+            connections.extend([service.conn for service in workload.services])
+    finally:
+        for conn in connections:
+            conn.close()
+        # lets the connections wind down
+        wait(loop, lambda: False, SETTLE_GRACE)
+        bus.stop()
+    result["workload"] = name
+    result["engine"] = args.engine
+    print(json.dumps(result))
+
+def ms(value):
+    if value == None:
+        return "-"
+    return "%.2f" % (value * 1000)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark event to notification latency")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help="comma separated, from %s" % ", ".join(WORKLOADS))
+    parser.add_argument("--engines", default="glib",
+                        help="comma separated, from %s" % ", ".join(engine.ENGINES))
+    parser.add_argument("--dbus-daemon", default="dbus-daemon")
+    parser.add_argument("--unthrottled", action="store_true",
+                        help="lift the rate limits of the notifier")
+    parser.add_argument("--devices", type=int, default=500,
+                        help="block devices present at startup")
+    parser.add_argument("--drives", type=int, default=50,
+                        help="drives plugged in one burst")
+    parser.add_argument("--battery-updates", type=int, default=30)
+    parser.add_argument("--battery-rate", type=float, default=1.0,
+                        help="battery updates per second")
+    parser.add_argument("--battery-start", type=int, default=40,
+                        help="battery level to discharge from")
+    parser.add_argument("--rfkill-updates", type=int, default=20)
+    parser.add_argument("--rfkill-rate", type=float, default=10.0,
+                        help="radio switch toggles per second")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--engine", default="glib", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args)
+        return
+
+    print("%-8s %-10s %11s %14s %7s %9s %9s %9s %12s %9s"
+          % ("engine", "workload", "startup ms", "startup calls", "events", "notified",
+             "p50 ms", "p99 ms", "calls/event", "RSS MB"))
+    names = args.workloads.split(",")
+    for name in names:
+        if not name in WORKLOAD_CLASSES:
+            parser.error("unknown workload %s" % name)
+    engines = args.engines.split(",")
+    for name in engines:
+        if not name in engine.ENGINES:
+            parser.error("unknown engine %s" % name)
+    failed = False
+    for engine_name in engines:
+        for name in names:
+            # one process each, so RSS and module state do not carry over
+            child = subprocess.Popen([sys.executable, "-m", "bench.latency", "--child", name,
+                                      "--engine", engine_name] + sys.argv[1:],
+                                     stdout=subprocess.PIPE, universal_newlines=True)
+            output = child.communicate()[0].strip().splitlines()
+            if child.returncode != 0 or not output:
+                print("%-8s %-10s failed" % (engine_name, name))
+                failed = True
+                continue
+            result = json.loads(output[-1])
+            calls = "-"
+            if result["calls_per_event"] != None:
+                calls = "%.2f" % result["calls_per_event"]
+            print("%-8s %-10s %11s %14d %7d %9d %9s %9s %12s %9.1f"
+                  % (engine_name, name, ms(result["startup"]), result["startup_calls"],
+                     result["events"], result["notified"],
+                     ms(result["p50"]), ms(result["p99"]), calls,
+                     result["rss"] / 1048576.0))
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
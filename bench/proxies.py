@@ -0,0 +1,114 @@
+from __future__ import absolute_import, print_function
+
+import argparse
+
+from collections import OrderedDict
+
+import dbus
+
+from nebel import engine
+from nebel.engine import clock
+from nebel.dbus import DBUS_PROPERTIES, DBUS_OBJECT_MANAGER, connect
+from nebel.udisks import UDISKS, UDISKS_PATH
+
+# startup cost of talking to every object of an ObjectManager
+#
+# Compares proxies with introspection, as dbus-python makes
+# them by default, to the ProxyFactory and to the
+# asynchronous calls that nebel issues without any proxy.
+#
+#   python -m bench.proxies [--dest NAME --path PATH] [--rounds N]
+#
+# Nebel itself only makes asynchronous calls, the factory
+# lives here for the comparison.
+
+# number of proxies to keep around
+PROXY_CACHE_SIZE = 1024
+
+# hands out proxies without introspection
+#
+# Proxies are interned by destination and path, so objects
+# that come and go share them. We know the signatures of
+# everything we call, so introspection data is never needed.
+class ProxyFactory:
+    def __init__(self, bus, size=PROXY_CACHE_SIZE):
+        self.bus = bus
+        self.size = size
+        self.proxies = OrderedDict()
+
+    def get_object(self, dest, path):
+        key = (dest, str(path))
+        proxy = self.proxies.pop(key, None)
+        if proxy == None:
+            proxy = self.bus.get_object(dest, path, introspect=False,
+                                        follow_name_owner_changes=False)
+            if len(self.proxies) >= self.size:
+                self.proxies.popitem(last=False)
+        self.proxies[key] = proxy
+        return proxy
+
+    def get_interface(self, dest, path, iface):
+        return dbus.Interface(self.get_object(dest, path), iface)
+
+def managed_objects(bus, dest, path):
+    objman = dbus.Interface(bus.get_object(dest, path), DBUS_OBJECT_MANAGER)
+    objs = objman.GetManagedObjects()
+    targets = list()
+    for obj in objs:
+        for iface in objs[obj]:
+            targets.append((str(obj), str(iface)))
+            break
+    return targets
+
+def bench_introspected(bus, dest, targets):
+    for path, iface in targets:
+        props = dbus.Interface(bus.get_object(dest, path), DBUS_PROPERTIES)
+        props.GetAll(iface)
+
+def bench_factory(factory, dest, targets):
+    for path, iface in targets:
+        props = factory.get_interface(dest, path, DBUS_PROPERTIES)
+        props.GetAll(iface)
+
+def bench_async(bus, dest, targets):
+    loop = engine.main_loop()
+    pending = [len(targets)]
+    def done(*args):
+        pending[0] -= 1
+        if pending[0] == 0:
+            loop.quit()
+    for path, iface in targets:
+        bus.call_async(dest, path, DBUS_PROPERTIES, "GetAll", "s", (iface,),
+                       done, done)
+    if targets:
+        loop.run()
+
+def measure(name, rounds, fn, *args):
+    times = list()
+    for i in range(rounds):
+        start = clock()
+        fn(*args)
+        times.append(clock() - start)
+    times.sort()
+    print("%-28s best %8.2f ms  median %8.2f ms"
+          % (name, times[0] * 1000, times[len(times) // 2] * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark proxy creation at startup")
+    parser.add_argument("--dest", default=UDISKS)
+    parser.add_argument("--path", default=UDISKS_PATH)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    bus = connect()
+    targets = managed_objects(bus, args.dest, args.path)
+    print("%d objects below %s" % (len(targets), args.path))
+
+    measure("introspected proxies", args.rounds, bench_introspected, bus, args.dest, targets)
+    factory = ProxyFactory(bus)
+    measure("proxy factory, cold", 1, bench_factory, factory, args.dest, targets)
+    measure("proxy factory, warm", args.rounds, bench_factory, factory, args.dest, targets)
+    measure("async calls, no proxies", args.rounds, bench_async, bus, args.dest, targets)
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,148 @@
+import sys
+import argparse
 import logging
-import glib
-import notify2 as notify
+import nebel.engine
+import nebel.notifications as notify
+import nebel.snapshot
+import nebel.dbus
 import nebel.udev
 import nebel.udisks
 import nebel.upower
+import nebel.powersupply
 import nebel.urfkill
+import nebel.rfkill
+import nebel.trace
+import nebel.instrument
+import nebel.stats
+import nebel.worker
 
 LOG_LEVEL = logging.INFO
 LOG_FORMAT = '%(asctime)-15s [%(name)-15s] %(levelname)s: %(message)s'
 logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
 
-main = glib.MainLoop()
+parser = argparse.ArgumentParser(description="Desktop notifications for system events")
+parser.add_argument("--engine", choices=nebel.engine.ENGINES, default="glib",
+                    help="run on glib and dbus-python or on asyncio and jeepney")
+parser.add_argument("--power-backend", choices=("upower", "sysfs"), default="upower",
+                    help="read power supplies from UPower or directly from sysfs")
+parser.add_argument("--rfkill-backend", choices=("urfkill", "kernel"), default="urfkill",
+                    help="read radio switches from URfkill or directly from /dev/rfkill")
+parser.add_argument("--udev-subsystem", action="append", dest="udev_subsystems",
+                    type=nebel.udev.subsystem_filter, metavar="SUBSYSTEM[:DEVTYPE]",
+                    help="watch udev events of SUBSYSTEM, of DEVTYPE only if given, "
+                    "instead of the default set, may be repeated")
+parser.add_argument("--udev-tag", action="append", dest="udev_tags", metavar="TAG",
+                    help="only watch udev events of devices tagged TAG, may be repeated")
+parser.add_argument("--record", metavar="FILE",
+                    help="append incoming signals and udev events to a trace file")
+parser.add_argument("--replay", metavar="FILE",
+                    help="replay a trace file instead of watching the system, "
+                    "notifications go to stdout")
+parser.add_argument("--replay-speed", type=float, default=1.0, metavar="FACTOR",
+                    help="speed up replays by FACTOR, 0 for as fast as possible")
+parser.add_argument("--instrument", action="store_true",
+                    help="time handlers, warn about main loop stalls and "
+                    "toggle profiling with SIGUSR2")
+parser.add_argument("--stall-threshold", type=int, default=nebel.instrument.STALL_THRESHOLD,
+                    metavar="MS", help="report handlers and stalls taking longer than MS")
+parser.add_argument("--no-stats", dest="stats", action="store_false",
+                    help="do not publish counters as %s on the session bus" % nebel.stats.STATS)
+parser.add_argument("--workers", action="store_true",
+                    help="run each monitor in a process of its own, restarted when it exits")
+parser.add_argument("--worker", choices=nebel.worker.WORKERS, help=argparse.SUPPRESS)
+parser.add_argument("--worker-fd", type=int, help=argparse.SUPPRESS)
+args = parser.parse_args()
+if args.replay and (args.power_backend != "upower" or args.rfkill_backend != "urfkill"):
+    parser.error("replays only cover the upower and urfkill backends")
+if args.workers and (args.replay or args.record):
+    parser.error("traces only cover a single process")
+if args.worker and args.worker_fd == None:
+    parser.error("workers need the descriptor of their front-end")
 
-notify.init("nebel")
+udev_subsystems = args.udev_subsystems or nebel.udev.UDEV_SUBSYSTEMS
+udev_tags = args.udev_tags or nebel.udev.UDEV_TAGS
 
-udev = nebel.udev.UDevMonitor()
-disks = nebel.udisks.DiskMonitor()
-power = nebel.upower.PowerMonitor()
-rfkill = nebel.urfkill.RfkillMonitor()
+# monitors running in this process
+if args.worker:
+    monitors = (args.worker,)
+elif args.workers:
+    monitors = ()
+else:
+    monitors = nebel.worker.WORKERS
 
-main.run()
+nebel.engine.use(args.engine)
+main = nebel.engine.main_loop()
+
+instrument = nebel.instrument.instrument
+if args.instrument:
+    instrument.enable(args.stall_threshold)
+
+recorder = None
+replayer = None
+supervisor = None
+udev = None
+if args.replay:
+    bus = nebel.trace.ReplayBus()
+    nebel.dbus.connect(bus)
+    notify.init("nebel", bus=nebel.trace.NotificationLog(sys.stdout))
+    udev = nebel.udev.UDevMonitor(udev_subsystems, udev_tags, listen=False)
+    replayer = nebel.trace.Replayer(args.replay, bus, udev, args.replay_speed, done=main.quit)
+elif args.worker:
+    # notifications go to the front-end, each worker keeps its own snapshot
+    nebel.worker.attach(args.worker_fd, done=main.quit)
+    nebel.snapshot.snapshot.load(args.worker)
+    if "udev" in monitors:
+        udev = nebel.udev.UDevMonitor(udev_subsystems, udev_tags)
+else:
+    notify.init("nebel")
+    if args.workers:
+        supervisor = nebel.worker.Supervisor()
+        supervisor.start()
+    else:
+        nebel.snapshot.snapshot.load()
+        udev = nebel.udev.UDevMonitor(udev_subsystems, udev_tags)
+    if args.record:
+        recorder = nebel.trace.Recorder(args.record)
+        nebel.dbus.connect()
+        nebel.dbus.router.tracer = recorder
+        nebel.dbus.caller.tracer = recorder
+        udev.tracer = recorder
+
+# monitors for system services start once their service is up
+registry = nebel.dbus.MonitorRegistry()
+# monitors that run on their own
+standalone = list()
+if "udisks" in monitors:
+    registry.register(nebel.udisks.UDISKS, nebel.udisks.DiskMonitor)
+if "power" in monitors:
+    if args.power_backend == "sysfs":
+        standalone.append(nebel.powersupply.SysfsPowerMonitor())
+    else:
+        registry.register(nebel.upower.UPOWER, nebel.upower.PowerMonitor)
+if "rfkill" in monitors:
+    rfkill = None
+    if args.rfkill_backend == "kernel":
+        rfkill = nebel.rfkill.KernelRfkillMonitor()
+    if rfkill != None and rfkill.present:
+        standalone.append(rfkill)
+    else:
+        if rfkill != None:
+            logging.warning("falling back to URfkill for radio switches")
+        registry.register(nebel.urfkill.URFKILL, nebel.urfkill.RfkillMonitor)
+if registry.factories:
+    registry.start()
+if replayer != None:
+    replayer.run()
+elif args.stats and not args.worker:
+    stats = nebel.stats.export(nebel.stats.Stats(registry, udev, standalone, supervisor))
+
+try:
+    main.run()
+finally:
+    if supervisor != None:
+        supervisor.stop()
+    nebel.snapshot.snapshot.save()
+    if recorder != None:
+        recorder.close()
+    if instrument.enabled:
+        instrument.report()
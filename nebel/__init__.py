@@ -1,2 +1,2 @@
 
-__all__ = ["dbus", "udev", "udisks", "upower", "urfkill"]
+__all__ = ["dbus", "engine", "instrument", "notifications", "notifier", "powersupply", "render", "rfkill", "snapshot", "stats", "trace", "udev", "udisks", "upower", "urfkill", "worker"]
@@ -0,0 +1,393 @@
+from __future__ import absolute_import
+
+import asyncio
+import itertools
+import logging
+
+from jeepney import DBusAddress, HeaderFields, MessageType, new_error, new_method_call, \
+    new_method_return, new_signal
+from jeepney.io.asyncio import open_dbus_connection
+
+from nebel import engine
+
+LOG = logging.getLogger("nebel.aio")
+
+DBUS = engine.DBUS
+DBUS_PATH = engine.DBUS_PATH
+DBUS_NO_REPLY = "org.freedesktop.DBus.Error.NoReply"
+
+# end of the complete type starting at index i
+def type_end(signature, i):
+    code = signature[i]
+    if code == "a":
+        return type_end(signature, i + 1)
+    if code in "({":
+        close = ")" if code == "(" else "}"
+        i += 1
+        while signature[i] != close:
+            i = type_end(signature, i)
+    return i + 1
+
+def split_signature(signature):
+    types = list()
+    i = 0
+    while i < len(signature):
+        end = type_end(signature, i)
+        types.append(signature[i:end])
+        i = end
+    return types
+
+# turns a jeepney value into what dbus-python hands out
+#
+# Variants come as (signature, value) and lose their
+# wrapping, byte arrays become strings with one character
+# per byte like dbus-python gives them with byte_arrays.
+def unwrap(signature, value):
+    code = signature[0]
+    if code == "v":
+        return unwrap(value[0], value[1])
+    if signature == "ay":
+        return value.decode("latin-1")
+    if signature.startswith("a{"):
+        key, item = split_signature(signature[2:-1])
+        return dict((unwrap(key, k), unwrap(item, v)) for k, v in value.items())
+    if code == "a":
+        return [unwrap(signature[1:], item) for item in value]
+    if code == "(":
+        return tuple(unwrap(type, item)
+                     for type, item in zip(split_signature(signature[1:-1]), value))
+    return value
+
+def unwrap_body(signature, body):
+    # most bodies have nothing to unwrap
+    if not "v" in signature and not "ay" in signature:
+        return list(body)
+    return [unwrap(type, item) for type, item in zip(split_signature(signature), body)]
+
+def header(message, field, default=None):
+    return message.header.fields.get(field, default)
+
+class BusError(Exception):
+    def __init__(self, name, message=""):
+        Exception.__init__(self, "%s: %s" % (name, message))
+        self.name = name
+
+# a message as the message filters see it from dbus-python
+class BusMessage(object):
+    __slots__ = ("message",)
+
+    def __init__(self, message):
+        self.message = message
+
+    def get_type(self):
+        return self.message.header.message_type.value
+
+    def get_path(self):
+        return header(self.message, HeaderFields.path)
+
+    def get_interface(self):
+        return header(self.message, HeaderFields.interface)
+
+    def get_member(self):
+        return header(self.message, HeaderFields.member)
+
+    def get_sender(self):
+        return header(self.message, HeaderFields.sender)
+
+    def get_args_list(self, byte_arrays=False):
+        return unwrap_body(header(self.message, HeaderFields.signature, ""), self.message.body)
+
+# unlike with dbus-python, the sender of a receiver must be
+# the bus itself or a unique name, well-known names are not
+# followed to their owner
+class SignalReceiver(object):
+    def __init__(self, bus, handler, member, iface, path, arg0, sender, sender_keyword, rule):
+        self.bus = bus
+        self.handler = handler
+        self.member = member
+        self.iface = iface
+        self.path = path
+        self.arg0 = arg0
+        self.sender = sender
+        self.sender_keyword = sender_keyword
+        self.rule = rule
+
+    def matches(self, path, iface, member, args, sender):
+        return ((self.member == None or self.member == member)
+                and (self.iface == None or self.iface == iface)
+                and (self.path == None or self.path == path)
+                and (self.arg0 == None or (args and args[0] == self.arg0))
+                and (self.sender == None or self.sender == sender))
+
+    def receive(self, args, sender):
+        if self.sender_keyword != None:
+            self.handler(*args, **{self.sender_keyword: sender})
+        else:
+            self.handler(*args)
+
+    def remove(self):
+        if self in self.bus.receivers:
+            self.bus.receivers.remove(self)
+            self.bus.remove_match_string_non_blocking(self.rule)
+
+# a bus connection with the parts of the dbus-python API nebel uses
+#
+# The connection is opened in the background, messages sent
+# before it is up wait for it. Replies and signals are
+# handed to their callbacks from a reader task, in the order
+# they arrive.
+class JeepneyBus(object):
+    def __init__(self, loop, address):
+        self.loop = loop
+        self.address = address
+        self.conn = None
+        self.closed = False
+        # messages waiting for the connection
+        self.outbox = list()
+        # callbacks for calls in flight by serial
+        self.replies = dict()
+        self.filters = list()
+        self.receivers = list()
+        self.task = loop.create_task(self.run())
+
+    async def run(self):
+        try:
+            self.conn = await open_dbus_connection(self.address)
+        except Exception as e:
+            LOG.error("can not connect to the %s bus: %s" % (self.address, e))
+            self.lost(e)
+            return
+        outbox = self.outbox
+        self.outbox = list()
+        for args in outbox:
+            self.send(*args)
+        while True:
+            try:
+                message = await self.conn.receive()
+            except Exception as e:
+                LOG.error("lost the %s bus: %s" % (self.address, e))
+                self.lost(e)
+                return
+            try:
+                self.dispatch(message)
+            except Exception:
+                LOG.exception("handling a message from the %s bus failed" % self.address)
+
+    # like dbus-python, calls in flight get no reply
+    def close(self):
+        self.closed = True
+        self.replies = dict()
+        self.outbox = list()
+        self.task.cancel()
+        if self.conn != None:
+            self.loop.create_task(self.conn.close())
+
+    def lost(self, e):
+        self.closed = True
+        err = BusError(DBUS_NO_REPLY, str(e))
+        for reply, error, timer in list(self.replies.values()):
+            if timer != None:
+                timer.cancel()
+            if error != None:
+                error(err)
+        self.replies = dict()
+        for message, reply, error, timeout in self.outbox:
+            if error != None:
+                error(err)
+        self.outbox = list()
+
+    def send(self, message, reply=None, error=None, timeout=None):
+        if self.closed:
+            if error != None:
+                self.loop.call_soon(error, BusError(DBUS_NO_REPLY, "not connected"))
+            return
+        if self.conn == None:
+            self.outbox.append((message, reply, error, timeout))
+            return
+        serial = next(self.conn.outgoing_serial)
+        if reply != None:
+            timer = None
+            if timeout != None and timeout > 0:
+                timer = self.loop.call_later(timeout, self.timed_out, serial)
+            self.replies[serial] = (reply, error, timer)
+        self.loop.create_task(self.conn.send(message, serial=serial))
+
+    def timed_out(self, serial):
+        reply, error, timer = self.replies.pop(serial, (None, None, None))
+        if error != None:
+            error(BusError(DBUS_NO_REPLY, "no reply in time"))
+
+    def dispatch(self, message):
+        kind = message.header.message_type
+        if kind == MessageType.method_return or kind == MessageType.error:
+            serial = header(message, HeaderFields.reply_serial)
+            reply, error, timer = self.replies.pop(serial, (None, None, None))
+            if timer != None:
+                timer.cancel()
+            if kind == MessageType.error:
+                if error != None:
+                    text = ""
+                    if message.body and isinstance(message.body[0], str):
+                        text = message.body[0]
+                    error(BusError(header(message, HeaderFields.error_name), text))
+            elif reply != None:
+                reply(*unwrap_body(header(message, HeaderFields.signature, ""), message.body))
+        else:
+            signal = BusMessage(message)
+            for filter in list(self.filters):
+                if filter(self, signal) == engine.HANDLER_RESULT_HANDLED:
+                    return
+            if kind == MessageType.signal and self.receivers:
+                path = signal.get_path()
+                iface = signal.get_interface()
+                member = signal.get_member()
+                args = signal.get_args_list()
+                sender = signal.get_sender()
+                for receiver in list(self.receivers):
+                    if receiver.matches(path, iface, member, args, sender):
+                        receiver.receive(args, sender)
+
+    def call_async(self, dest, path, iface, method, signature, args,
+                   reply, error, timeout=None, byte_arrays=False):
+        message = new_method_call(DBusAddress(str(path), bus_name=dest, interface=iface),
+                                  method, signature or None, tuple(args))
+        self.send(message, reply, error, timeout)
+
+    def add_message_filter(self, filter):
+        self.filters.append(filter)
+
+    def add_match_string_non_blocking(self, rule):
+        self.call_async(DBUS, DBUS_PATH, DBUS, "AddMatch", "s", (rule,), lambda: None,
+                        lambda err: LOG.warning("adding match %s failed: %s" % (rule, err)))
+
+    def remove_match_string_non_blocking(self, rule):
+        self.call_async(DBUS, DBUS_PATH, DBUS, "RemoveMatch", "s", (rule,), lambda: None,
+                        lambda err: LOG.warning("removing match %s failed: %s" % (rule, err)))
+
+    def add_signal_receiver(self, handler, signal_name=None, dbus_interface=None,
+                            bus_name=None, path=None, arg0=None, sender_keyword=None,
+                            **kwargs):
+        parts = ["type='signal'"]
+        for key, value in (("sender", bus_name), ("interface", dbus_interface),
+                           ("member", signal_name), ("path", path), ("arg0", arg0)):
+            if value != None:
+                parts.append("%s='%s'" % (key, value))
+        rule = ",".join(parts)
+        self.add_match_string_non_blocking(rule)
+        receiver = SignalReceiver(self, handler, signal_name, dbus_interface, path, arg0,
+                                  bus_name, sender_keyword, rule)
+        self.receivers.append(receiver)
+        return receiver
+
+class AsyncioMainLoop(object):
+    def __init__(self, loop):
+        self.loop = loop
+
+    def run(self):
+        self.loop.run_forever()
+
+    def quit(self):
+        self.loop.stop()
+
+# timers, IO watches and buses on an asyncio loop
+#
+# Sources keep the glib semantics: callbacks that return
+# True run again, timers counting from when they returned,
+# and any source can be removed by its id.
+class AsyncioEngine(object):
+    name = "asyncio"
+
+    def __init__(self, loop=None):
+        if loop == None:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+        self.loop = loop
+        self.ids = itertools.count(1)
+        # timer handles, or file descriptors of IO watches, by id
+        self.sources = dict()
+
+    def timeout_add(self, ms, fn, *args):
+        source = next(self.ids)
+        self.sources[source] = self.loop.call_later(ms / 1000.0, self.fire, source, ms, fn, args)
+        return source
+
+    def idle_add(self, fn, *args):
+        source = next(self.ids)
+        self.sources[source] = self.loop.call_soon(self.fire, source, None, fn, args)
+        return source
+
+    def fire(self, source, ms, fn, args):
+        again = False
+        try:
+            again = fn(*args)
+        except Exception:
+            LOG.exception("callback %r failed" % (fn,))
+        if not source in self.sources:
+            # removed by the callback
+            return
+        if not again:
+            del self.sources[source]
+        elif ms == None:
+            self.sources[source] = self.loop.call_soon(self.fire, source, ms, fn, args)
+        else:
+            self.sources[source] = self.loop.call_later(ms / 1000.0, self.fire, source, ms, fn, args)
+
+    # hangups and errors show up as the descriptor being readable
+    def io_add_watch(self, fd, condition, fn):
+        source = next(self.ids)
+        self.sources[source] = fd
+        self.loop.add_reader(fd, self.readable, source, fd, fn)
+        return source
+
+    def readable(self, source, fd, fn):
+        again = False
+        try:
+            again = fn(fd, engine.IO_IN)
+        except Exception:
+            LOG.exception("IO watch %r failed" % (fn,))
+        if not again and self.sources.get(source) == fd:
+            del self.sources[source]
+            self.loop.remove_reader(fd)
+
+    def source_remove(self, source):
+        handle = self.sources.pop(source, None)
+        if isinstance(handle, int):
+            self.loop.remove_reader(handle)
+        elif handle != None:
+            handle.cancel()
+
+    def main_loop(self):
+        return AsyncioMainLoop(self.loop)
+
+    def system_bus(self):
+        return JeepneyBus(self.loop, "SYSTEM")
+
+    def session_bus(self):
+        return JeepneyBus(self.loop, "SESSION")
+
+    def open_bus(self, address):
+        return JeepneyBus(self.loop, address)
+
+    # variants are (signature, value) for jeepney
+    def variant(self, signature, value):
+        return (signature, value)
+
+    def serve(self, bus, handler):
+        def filter(bus, message):
+            if message.get_type() != engine.MESSAGE_TYPE_METHOD_CALL:
+                return engine.HANDLER_RESULT_NOT_YET_HANDLED
+            error, signature, values = engine.answer(handler, message.get_path(),
+                                                     message.get_interface(),
+                                                     message.get_member(),
+                                                     message.get_args_list())
+            if error != None:
+                reply = new_error(message.message, error, signature, values)
+            else:
+                reply = new_method_return(message.message, signature or None, tuple(values))
+            bus.send(reply)
+            return engine.HANDLER_RESULT_HANDLED
+        bus.add_message_filter(filter)
+
+    def emit(self, bus, path, iface, member, signature, args):
+        bus.send(new_signal(DBusAddress(path, interface=iface), member,
+                            signature or None, tuple(args)))
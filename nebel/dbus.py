@@ -2,85 +2,464 @@ from __future__ import absolute_import
 
 import logging
 
-import dbus
-import dbus.mainloop.glib
+from enum import Enum
 
-import notify2 as notify
+from nebel import engine
+from nebel import notifications as notify
+from nebel.instrument import instrument
+from nebel.notifier import NOTIFY_WINDOW, notifier
+from nebel.render import Renderer
+from nebel.snapshot import snapshot
+
+try:
+    intern
+except NameError:
+    from sys import intern
 
 LOG = logging.getLogger("nebel.dbus")
 
+DBUS = "org.freedesktop.DBus"
+DBUS_PATH = "/org/freedesktop/DBus"
 DBUS_PROPERTIES = "org.freedesktop.DBus.Properties"
 DBUS_OBJECT_MANAGER = "org.freedesktop.DBus.ObjectManager"
 
-mainloop = dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-sysbus = dbus.SystemBus()
+# timeout for method calls in seconds
+CALL_TIMEOUT = 10.0
+
+sysbus = None
+router = None
+caller = None
+
+class SignalRoute:
+    def __init__(self, router, key, handler):
+        self.router = router
+        self.key = key
+        self.handler = handler
+
+    def remove(self):
+        self.router.disconnect(self.key, self.handler)
+
+# dispatches signals to handlers by (path, interface, member)
+#
+# Instead of one match rule per object and signal we install
+# a single path_namespace rule per service and route the
+# signals to their handlers ourselves.
+#
+# Match rules only decide which broadcasts we get, any client
+# can send a signal to us directly. Routed signals must come
+# from the unique name that owns the service of the route,
+# the owners are kept up to date by the MonitorRegistry.
+class SignalRouter:
+    def __init__(self, bus):
+        self.bus = bus
+        self.rules = dict()
+        # (service, handler) by (path, interface, member)
+        self.routes = dict()
+        # unique names by the services they own
+        self.owners = dict()
+        # signals received by interface
+        self.received = dict()
+        # signals dropped for their sender by service
+        self.rejected = dict()
+        # records incoming signals if set
+        self.tracer = None
+        self.bus.add_message_filter(self.filter)
+
+    def subscribe(self, dest, namespace):
+        if namespace in self.rules:
+            return
+        rule = ("type='signal',sender='%s',path_namespace='%s'"
+                % (dest, namespace))
+        LOG.debug("subscribing %s" % rule)
+        self.bus.add_match_string_non_blocking(rule)
+        self.rules[namespace] = rule
+
+    # also drops all routes below the namespace
+    def unsubscribe(self, namespace):
+        if namespace in self.rules:
+            rule = self.rules.pop(namespace)
+            LOG.debug("unsubscribing %s" % rule)
+            self.bus.remove_match_string_non_blocking(rule)
+        for key in list(self.routes.keys()):
+            if key[0] == namespace or key[0].startswith(namespace + "/"):
+                del self.routes[key]
+
+    def owned(self, dest, owner):
+        if owner:
+            self.owners[dest] = str(owner)
+        else:
+            self.owners.pop(dest, None)
+
+    def connect(self, dest, path, iface, member, handler):
+        key = (str(path), iface, member)
+        self.routes[key] = (dest, handler)
+        return SignalRoute(self, key, handler)
+
+    def disconnect(self, key, handler):
+        route = self.routes.get(key)
+        if route != None and route[1] == handler:
+            del self.routes[key]
+
+    def filter(self, bus, message):
+        if message.get_type() == engine.MESSAGE_TYPE_SIGNAL:
+            key = (message.get_path(), message.get_interface(), message.get_member())
+            self.received[key[1]] = self.received.get(key[1], 0) + 1
+            route = self.routes.get(key)
+            handler = None
+            if route != None:
+                dest, handler = route
+                sender = message.get_sender()
+                if sender == None or sender != self.owners.get(dest):
+                    LOG.warning("dropping %s.%s on %s from %s, not the owner of %s"
+                                % (key[1], key[2], key[0], sender, dest))
+                    self.rejected[dest] = self.rejected.get(dest, 0) + 1
+                    handler = None
+            if handler != None or self.tracer != None:
+                args = message.get_args_list(byte_arrays=True)
+                if self.tracer != None:
+                    self.tracer.signal(key, args, message.get_sender())
+            if handler != None:
+                try:
+                    instrument.run(("signal", key[1], key[2]), key[0], handler, *args)
+                except Exception:
+                    LOG.exception("signal handler for %s.%s on %s failed"
+                                  % (key[1], key[2], key[0]))
+        # other receivers on the connection may want it too
+        return engine.HANDLER_RESULT_NOT_YET_HANDLED
+
+# issues method calls without blocking the main loop
+#
+# Identical calls that are still in flight are coalesced,
+# all callers get the same reply.
+class AsyncCaller:
+    def __init__(self, bus):
+        self.bus = bus
+        self.pending = dict()
+        # calls issued and coalesced by destination
+        self.calls = dict()
+        self.coalesced = dict()
+        # records replies if set
+        self.tracer = None
+
+    def call(self, dest, path, iface, method, signature, args,
+             reply, error=None, timeout=CALL_TIMEOUT):
+        key = (dest, str(path), iface, method, tuple(args))
+        if key in self.pending:
+            LOG.debug("coalescing %s.%s on %s" % (iface, method, path))
+            self.pending[key].append((reply, error))
+            self.coalesced[dest] = self.coalesced.get(dest, 0) + 1
+            return
+        self.pending[key] = [(reply, error)]
+        self.calls[dest] = self.calls.get(dest, 0) + 1
+        self.bus.call_async(dest, path, iface, method, signature, args,
+                            lambda *ret: self.replied(key, ret),
+                            lambda err: self.failed(key, err),
+                            timeout=timeout, byte_arrays=True)
+
+    def replied(self, key, ret):
+        if self.tracer != None:
+            self.tracer.reply(key, ret)
+        for reply, error in self.pending.pop(key, ()):
+            try:
+                instrument.run(("reply", key[2], key[3]), key[1], reply, *ret)
+            except Exception:
+                LOG.exception("reply handler for %s.%s on %s failed"
+                              % (key[2], key[3], key[1]))
+
+    def failed(self, key, err):
+        LOG.warning("call %s.%s on %s failed: %s" % (key[2], key[3], key[1], err))
+        for reply, error in self.pending.pop(key, ()):
+            if error != None:
+                error(err)
+
+# connects to the system bus on first use,
+# or to a stand-in for it like a trace replay
+def connect(bus=None):
+    global sysbus, router, caller
+    if sysbus == None:
+        if bus == None:
+            bus = engine.system_bus()
+        sysbus = bus
+        router = SignalRouter(sysbus)
+        caller = AsyncCaller(sysbus)
+    return sysbus
+
+# starts monitors while their service is on the bus
+#
+# One ListNames call at startup finds the services that are
+# already running, NameOwnerChanged reports the ones that
+# come and go later. Monitors for services that are not
+# running cost nothing and are not activated by us. Monitors
+# start once the unique name of their service is known, the
+# router only takes signals from it.
+class MonitorRegistry:
+    def __init__(self):
+        self.factories = dict()
+        self.monitors = dict()
+        self.signals = list()
+
+    def register(self, name, factory):
+        self.factories[name] = factory
+
+    def start(self):
+        bus = connect()
+        for name in self.factories:
+            self.signals.append(bus.add_signal_receiver(
+                self.name_owner_changed, signal_name="NameOwnerChanged",
+                dbus_interface=DBUS, bus_name=DBUS, path=DBUS_PATH, arg0=name))
+        caller.call(DBUS, DBUS_PATH, DBUS, "ListNames", "", (), self.names_listed)
+
+    def stop(self):
+        for signal in self.signals:
+            signal.remove()
+        self.signals = list()
+        for name in list(self.monitors.keys()):
+            self.deactivate(name)
+
+    def names_listed(self, names):
+        for name in names:
+            if name in self.factories:
+                name = str(name)
+                caller.call(DBUS, DBUS_PATH, DBUS, "GetNameOwner", "s", (name,),
+                            lambda owner, name=name: self.name_owned(name, owner))
+
+    def name_owned(self, name, owner):
+        # a NameOwnerChanged may have been quicker
+        if not name in self.monitors:
+            router.owned(name, owner)
+            self.activate(name)
+
+    def stats(self):
+        return dict((name, monitor.stats()) for name, monitor in self.monitors.items())
+
+    def name_owner_changed(self, name, old, new):
+        name = str(name)
+        LOG.debug("owner of %s changed from %r to %r" % (name, old, new))
+        if old:
+            self.deactivate(name)
+        router.owned(name, new)
+        if new:
+            self.activate(name)
+
+    def activate(self, name):
+        if not name in self.monitors:
+            LOG.info("activating monitor for %s" % name)
+            self.monitors[name] = self.factories[name]()
+
+    def deactivate(self, name):
+        monitor = self.monitors.pop(name, None)
+        if monitor != None:
+            LOG.info("deactivating monitor for %s" % name)
+            monitor.detach()
+
+# gives object classes __slots__ for their state
+#
+# The slots are generated from the property schema, the
+# SNAPSHOT attributes and SLOTS for everything else a class
+# keeps, so tracked objects carry no per-instance __dict__.
+# Attributes that are not declared can not be set.
+class Schema(type):
+    def __new__(meta, name, bases, attrs):
+        if not "__slots__" in attrs:
+            names = list()
+            properties = attrs.get("PROPERTIES", {})
+            for iface in properties:
+                for prop, conv in properties[iface]:
+                    names.append(prop)
+            names.extend(attrs.get("SNAPSHOT") or ())
+            names.extend(attrs.get("SLOTS", ()))
+            inherited = set()
+            for base in bases:
+                for cls in base.__mro__:
+                    inherited.update(getattr(cls, "__slots__", ()))
+            slots = list()
+            for attr in names:
+                if not attr in inherited and not attr in slots:
+                    slots.append(attr)
+            attrs["__slots__"] = tuple(slots)
+        return type.__new__(meta, name, bases, attrs)
+
+SchemaObject = Schema("SchemaObject", (object,), {})
+
+class DbusObject(SchemaObject):
+    # properties fetched by update_props, as
+    # {interface: ((name, converter), ...)}
+    PROPERTIES = {}
+
+    # attributes kept across restarts besides the properties,
+    # None if the object is not kept
+    SNAPSHOT = None
+
+    # other attributes of instances
+    SLOTS = ("log", "dest", "path", "ifaces", "init", "present",
+             "notifs", "renderer", "signals", "sigpchg")
 
-class DbusObject:
     def __init__(self, dest, path, ifaces, log=None):
         if log != None:
             self.log = log
         else:
             self.log = LOG
         self.dest = dest
-        self.path = path
+        self.path = str(path)
         self.ifaces = ifaces
         self.init = False
-        self.obj = sysbus.get_object(dest, path)
-        self.props = dbus.Interface(self.obj, DBUS_PROPERTIES)
+        self.present = False
         self.notifs = dict()
+        self.renderer = None
+        self.signals = list()
         self.sigpchg = None
 
-    def get_interface(self, iface):
-        return dbus.Interface(self.obj, iface)
+    # subscribe to all signals from our service below our path
+    #
+    # Like calls this connects to the bus on first use, objects
+    # that get their state elsewhere never do.
+    def subscribe(self):
+        connect()
+        router.subscribe(self.dest, self.path)
+
+    def unsubscribe(self):
+        if router != None:
+            router.unsubscribe(self.path)
+
+    def connect_signal(self, iface, member, handler):
+        connect()
+        route = router.connect(self.dest, self.path, iface, member, handler)
+        self.signals.append(route)
+        return route
+
+    # routes hold on to their handlers, and so to us
+    def disconnect_signals(self):
+        for route in self.signals:
+            route.remove()
+        self.signals = list()
+
+    def call(self, iface, method, signature, args, reply, error=None):
+        def replied(*ret):
+            # we may have been removed while the call was in flight
+            if self.present:
+                reply(*ret)
+        connect()
+        caller.call(self.dest, self.path, iface, method, signature, args,
+                    replied, error)
 
     def added(self):
         self.log.info("added %s" % self.path)
+        self.present = True
+        if self.SNAPSHOT != None:
+            snapshot.restore(self)
         self.update()
 
     def removed(self):
         self.log.info("removed %s" % self.path)
+        self.present = False
+        self.disconnect_signals()
+        if self.SNAPSHOT != None:
+            snapshot.forget(self)
+
+    # our service went away, drop the object without notifying
+    def detach(self):
+        self.log.info("detached %s" % self.path)
+        self.present = False
+        self.disconnect_signals()
+        if self.SNAPSHOT != None:
+            snapshot.release(self)
+
+    def snapshot(self):
+        state = dict()
+        for iface in self.PROPERTIES:
+            for name, conv in self.PROPERTIES[iface]:
+                state[name] = getattr(self, name, None)
+        for name in self.SNAPSHOT:
+            state[name] = getattr(self, name, None)
+        for name in state:
+            if isinstance(state[name], Enum):
+                state[name] = state[name].value
+        return state
+
+    # restored objects diff their first update against the snapshot
+    def restore(self, state):
+        for iface in self.PROPERTIES:
+            for name, conv in self.PROPERTIES[iface]:
+                if state.get(name) != None:
+                    self.set_prop(iface, name, conv, state[name])
+        for name in self.SNAPSHOT:
+            if state.get(name) != None:
+                setattr(self, name, state[name])
+        self.init = True
 
     def update(self):
         self.log.debug("updating %s" % self.path)
 
-    def update_prop(self, iface, name, conv):
-        raw = self.props.Get(iface, name, byte_arrays=True)
+    def props_updated(self, changed):
+        self.log.debug("props updated %s: %s" % (self.path, ", ".join(changed)))
+        if changed and self.SNAPSHOT != None:
+            snapshot.changed(self)
+
+    # fetches a single property, reports it if it changed
+    def update_prop(self, iface, name):
+        def reply(raw):
+            changed = self.apply_props(iface, {name: raw})
+            if changed:
+                self.props_updated(changed)
+        self.call(DBUS_PROPERTIES, "Get", "ss", (iface, name), reply)
+
+    # fetches all properties of an interface, always reports
+    def update_props(self, iface, error=None):
+        def reply(raw):
+            self.props_updated(self.apply_props(iface, raw))
+        self.call(DBUS_PROPERTIES, "GetAll", "s", (iface,), reply, error)
+
+    # applies raw values and returns the old values of changed properties
+    def apply_props(self, iface, raw):
+        changed = dict()
+        for name, conv in self.PROPERTIES[iface]:
+            if name in raw:
+                old = getattr(self, name, None)
+                if self.set_prop(iface, name, conv, raw[name]) != old:
+                    changed[name] = old
+        return changed
+
+    def set_prop(self, iface, name, conv, raw):
         new = conv(raw)
         if conv == str:
-            new = new.rstrip('\0')
+            # the same vendors, buses and paths show up again and again
+            new = intern(new.rstrip('\0'))
         setattr(self, name, new)
         self.log.debug("property %s.%s = %s" % (iface, name, new))
+        return new
 
-    def renotify(self, name, summary, message='', timeout=1000, urgency=notify.URGENCY_LOW):
+    def renotify(self, name, summary, message='', timeout=1000, urgency=notify.URGENCY_LOW,
+                 window=NOTIFY_WINDOW):
         self.log.info("renotify %s urgency %s timeout %s summary \"%s\" message \"%s\"" % (name, urgency, timeout, summary, message))
-        if name in self.notifs:
-            n = self.notifs[name]
-            n.update(summary, message)
-        else:
-            n = notify.Notification(summary, message)
-            self.notifs[name] = n
-        n.set_timeout(timeout)
-        n.set_urgency(urgency)
-        n.show()
-        return n
+        notifier.show(self, name, summary, message, timeout, urgency, window)
+
+    # renders a section of a notification, cached until its inputs change
+    def render(self, key, render, *inputs):
+        if self.renderer == None:
+            self.renderer = Renderer()
+        return self.renderer.section(key, render, *inputs)
+
+    def unrender(self, key):
+        if self.renderer != None:
+            self.renderer.discard(key)
 
     def recancel(self, name):
         self.log.info("recancel %s" % name)
-        n = None
-        if name in self.notifs:
-            n = self.notifs[name]
-            n.close()
-            del self.notifs[name]
-        return n
+        notifier.cancel(self, name)
 
 class DbusObjectManager(DbusObject):
+    SLOTS = ("objs", "objifs", "sigadd", "sigdel")
 
     def __init__(self, dest, path, ifaces, log=None):
         DbusObject.__init__(self, dest, path, ifaces, log)
-        self.objman = dbus.Interface(self.obj, DBUS_OBJECT_MANAGER)
         self.objs = dict()
+        # interfaces of each object, it goes away with the last one
+        self.objifs = dict()
+        self.sigadd = None
+        self.sigdel = None
 
     def added(self):
+        self.subscribe()
         DbusObject.added(self)
         self.connect_ifs()
         self.enumerate()
@@ -88,14 +467,28 @@ class DbusObjectManager(DbusObject):
     def removed(self):
         DbusObject.removed(self)
         self.disconnect_ifs()
+        self.unsubscribe()
+
+    def detach(self):
+        for obj in self.objs.values():
+            obj.detach()
+        self.objs = dict()
+        self.objifs = dict()
+        self.disconnect_ifs()
+        self.unsubscribe()
+        DbusObject.detach(self)
 
     def enumerate(self):
-        objs = self.objman.GetManagedObjects()
+        self.call(DBUS_OBJECT_MANAGER, "GetManagedObjects", "", (), self.enumerated)
+
+    def enumerated(self, objs):
         for obj in objs:
             self.ifs_added(obj, objs[obj])
+        self.objs_vanished(snapshot.leftovers(self.path))
 
     def ifs_added(self, path, ifprops):
         self.log.debug("ifaces added %s: %r" % (path, ifprops))
+        path = str(path)
         obj = None
         new = False
         if not path in self.objs:
@@ -106,19 +499,26 @@ class DbusObjectManager(DbusObject):
         else:
             obj = self.objs[path]
         if obj != None:
+            self.objifs.setdefault(path, set()).update([intern(str(iface)) for iface in ifprops])
             if new:
                 obj.added()
             obj.ifs_added(ifprops)
 
     def ifs_removed(self, path, difs):
         self.log.debug("ifaces removed %s: %r" % (path, difs))
-        obj = None
-        if path in self.objs:
-            obj = self.objs[path]
-            del self.objs[path]
-            self.obj_destroy(obj, difs)
-            # XXX strictly incorrect
-            obj.removed()
+        path = str(path)
+        if not path in self.objs:
+            return
+        obj = self.objs[path]
+        ifs = self.objifs[path]
+        ifs.difference_update(map(str, difs))
+        if ifs:
+            obj.ifs_removed(difs)
+            return
+        del self.objs[path]
+        del self.objifs[path]
+        self.obj_destroy(obj, difs)
+        obj.removed()
 
     def obj_instantiate(self, path, ifprops):
         return None
@@ -126,9 +526,14 @@ class DbusObjectManager(DbusObject):
     def obj_destroy(self, obj, difs):
         pass
 
+    # objects in the snapshot that went away while we were not
+    # looking, as {path: state}
+    def objs_vanished(self, states):
+        pass
+
     def connect_ifs(self):
-        self.sigadd = self.objman.connect_to_signal("InterfacesAdded", self.ifs_added)
-        self.sigdel = self.objman.connect_to_signal("InterfacesRemoved", self.ifs_removed)
+        self.sigadd = self.connect_signal(DBUS_OBJECT_MANAGER, "InterfacesAdded", self.ifs_added)
+        self.sigdel = self.connect_signal(DBUS_OBJECT_MANAGER, "InterfacesRemoved", self.ifs_removed)
 
     def disconnect_ifs(self):
         if self.sigadd != None:
@@ -149,7 +554,7 @@ class DbusPropsObject(DbusObject):
         DbusObject.removed(self)
 
     def connect_props_changed(self):
-        self.sigpchg = self.obj.connect_to_signal("PropertiesChanged", self.props_changed)
+        self.sigpchg = self.connect_signal(DBUS_PROPERTIES, "PropertiesChanged", self.props_changed)
 
     def disconnect_props_changed(self):
         if self.sigpchg != None:
@@ -159,6 +564,16 @@ class DbusPropsObject(DbusObject):
     def props_changed(self, interface, changed, invalidated):
         self.log.debug("props changed %s: %r (changed %r, invalidated %r)"
                        % (self.path, interface, changed, invalidated))
-        for iface in self.ifaces:
-            if interface == iface:
-                self.update()
+        iface = str(interface)
+        if not iface in self.PROPERTIES:
+            return
+        # the pending initial update will be more recent
+        if not self.init:
+            return
+        # use the values from the signal, fetch only invalidated ones
+        changed = self.apply_props(iface, changed)
+        if changed:
+            self.props_updated(changed)
+        for name, conv in self.PROPERTIES[iface]:
+            if name in invalidated:
+                self.update_prop(iface, name)
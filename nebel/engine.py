@@ -0,0 +1,207 @@
+from __future__ import absolute_import
+
+import time
+
+# conditions for IO watches, as glib has them
+IO_IN = 1
+IO_ERR = 8
+IO_HUP = 16
+
+# types of messages and results of message filters,
+# as dbus-python has them
+MESSAGE_TYPE_METHOD_CALL = 1
+MESSAGE_TYPE_SIGNAL = 4
+HANDLER_RESULT_HANDLED = 0
+HANDLER_RESULT_NOT_YET_HANDLED = 1
+
+DBUS = "org.freedesktop.DBus"
+DBUS_PATH = "/org/freedesktop/DBus"
+DBUS_ERROR_FAILED = "org.freedesktop.DBus.Error.Failed"
+DBUS_ERROR_UNKNOWN_METHOD = "org.freedesktop.DBus.Error.UnknownMethod"
+
+# reply to RequestName when we got the name
+DBUS_REQUEST_NAME_PRIMARY_OWNER = 1
+
+# dbus-python types by their signature
+DBUS_TYPES = {
+    "b": "Boolean", "y": "Byte", "n": "Int16", "q": "UInt16",
+    "i": "Int32", "u": "UInt32", "x": "Int64", "t": "UInt64",
+    "d": "Double", "s": "String", "o": "ObjectPath", "g": "Signature",
+}
+
+ENGINES = ("glib", "asyncio")
+
+engine = None
+
+# timers, IO watches and buses from glib and dbus-python
+#
+# GLib comes from PyGObject's introspection bindings, or from
+# the static ones where those are all there is.
+class GLibEngine(object):
+    name = "glib"
+
+    def __init__(self):
+        try:
+            from gi.repository import GLib as glib
+            self.introspected = True
+        except ImportError:
+            import glib
+            self.introspected = False
+        import dbus
+        import dbus.mainloop.glib
+        self.glib = glib
+        self.dbus = dbus
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+    def timeout_add(self, ms, fn, *args):
+        return self.glib.timeout_add(ms, fn, *args)
+
+    def idle_add(self, fn, *args):
+        return self.glib.idle_add(fn, *args)
+
+    def source_remove(self, source):
+        self.glib.source_remove(source)
+
+    def io_add_watch(self, fd, condition, fn):
+        if self.introspected:
+            return self.glib.io_add_watch(fd, self.glib.PRIORITY_DEFAULT, condition, fn)
+        return self.glib.io_add_watch(fd, condition, fn)
+
+    def main_loop(self):
+        return self.glib.MainLoop()
+
+    def system_bus(self):
+        return self.dbus.SystemBus()
+
+    def session_bus(self):
+        return self.dbus.SessionBus()
+
+    def open_bus(self, address):
+        import dbus.bus
+        return dbus.bus.BusConnection(address)
+
+    # a value that keeps its type inside a variant
+    def variant(self, signature, value):
+        if signature == "ay":
+            return self.dbus.ByteArray(value)
+        if signature.startswith("a{"):
+            return self.dbus.Dictionary(value, signature=signature[2:-1])
+        if signature.startswith("a"):
+            return self.dbus.Array(value, signature=signature[1:])
+        return getattr(self.dbus, DBUS_TYPES[signature])(value)
+
+    def serve(self, bus, handler):
+        import dbus.lowlevel
+        def filter(bus, message):
+            if message.get_type() != MESSAGE_TYPE_METHOD_CALL:
+                return HANDLER_RESULT_NOT_YET_HANDLED
+            error, signature, values = answer(handler, message.get_path(),
+                                              message.get_interface(), message.get_member(),
+                                              message.get_args_list(byte_arrays=True))
+            if error != None:
+                reply = dbus.lowlevel.ErrorMessage(message, error, values[0])
+            else:
+                reply = dbus.lowlevel.MethodReturnMessage(message)
+                reply.append(signature=signature, *values)
+            bus.send_message(reply)
+            return HANDLER_RESULT_HANDLED
+        bus.add_message_filter(filter)
+
+    def emit(self, bus, path, iface, member, signature, args):
+        import dbus.lowlevel
+        message = dbus.lowlevel.SignalMessage(path, iface, member)
+        message.append(signature=signature, *args)
+        bus.send_message(message)
+
+# picks the engine everything runs on
+#
+# Nebel only talks to its event loop through the functions
+# below, so monitors run unchanged on either engine. The
+# glib engine is used unless another one is picked before
+# the first timer or bus is asked for. The asyncio engine
+# takes the loop to run on, for running inside another
+# asyncio program.
+def use(name="glib", **kwargs):
+    global engine
+    if name == "asyncio":
+        from nebel.aio import AsyncioEngine
+        engine = AsyncioEngine(**kwargs)
+    elif name == "glib":
+        engine = GLibEngine(**kwargs)
+    else:
+        raise ValueError("unknown engine %s" % name)
+    return engine
+
+def current():
+    if engine == None:
+        use()
+    return engine
+
+# seconds for measuring time spans, immune to clock changes
+# where the platform has a monotonic clock
+clock = getattr(time, "monotonic", time.time)
+
+def timeout_add(ms, fn, *args):
+    return current().timeout_add(ms, fn, *args)
+
+def idle_add(fn, *args):
+    return current().idle_add(fn, *args)
+
+def source_remove(source):
+    current().source_remove(source)
+
+def io_add_watch(fd, condition, fn):
+    return current().io_add_watch(fd, condition, fn)
+
+def main_loop():
+    return current().main_loop()
+
+def system_bus():
+    return current().system_bus()
+
+def session_bus():
+    return current().session_bus()
+
+def open_bus(address):
+    return current().open_bus(address)
+
+def variant(signature, value):
+    return current().variant(signature, value)
+
+# a byte that keeps its type inside a variant
+def byte(value):
+    return variant("y", value)
+
+# calls handler(path, iface, member, args) for a method call,
+# returns the error name or None, the signature and the values
+# of the reply
+def answer(handler, path, iface, member, args):
+    try:
+        ret = handler(path, iface, member, args)
+    except Exception as e:
+        return DBUS_ERROR_FAILED, "s", (str(e),)
+    if ret == None:
+        return DBUS_ERROR_UNKNOWN_METHOD, "s", ("no method %s.%s on %s" % (iface, member, path),)
+    signature, values = ret
+    return None, signature, values
+
+# answers the method calls that reach a bus and owns name on it
+#
+# The handler returns the signature and values of the reply,
+# None for methods it does not know. Calls that raise are
+# answered with an error. Once the name is ours, ready is
+# called. This is the service side of a bus, for standing in
+# for system services.
+def export(bus, name, handler, ready=None, error=None):
+    current().serve(bus, handler)
+    def named(code):
+        if code == DBUS_REQUEST_NAME_PRIMARY_OWNER:
+            if ready != None:
+                ready()
+        elif error != None:
+            error("%s is owned by someone else" % name)
+    bus.call_async(DBUS, DBUS_PATH, DBUS, "RequestName", "su", (name, 0),
+                   named, error or (lambda err: None))
+
+def emit(bus, path, iface, member, signature, args):
+    current().emit(bus, path, iface, member, signature, args)
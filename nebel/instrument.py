@@ -0,0 +1,146 @@
+from __future__ import absolute_import
+
+import os
+import signal
+import logging
+import cProfile
+
+from nebel import engine
+from nebel.engine import clock
+from nebel.snapshot import runtime_dir
+
+LOG = logging.getLogger("nebel.instrument")
+
+# handlers and loop iterations taking longer than this
+# are reported, in milliseconds
+STALL_THRESHOLD = 100
+
+# interval of the main loop heartbeat in milliseconds
+WATCHDOG_INTERVAL = 100
+
+# upper bounds of the histogram buckets in milliseconds,
+# the last bucket takes everything above
+HISTOGRAM_BOUNDS = (0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000)
+
+# starts and stops a profile capture
+PROFILE_SIGNAL = signal.SIGUSR2
+
+def profile_path(count):
+    runtime = runtime_dir()
+    if runtime == None:
+        return None
+    return os.path.join(runtime, "profile-%d-%d.prof" % (os.getpid(), count))
+
+class Histogram(object):
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        index = 0
+        for bound in HISTOGRAM_BOUNDS:
+            if ms <= bound:
+                break
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def format(self):
+        buckets = list()
+        for bound, count in zip(HISTOGRAM_BOUNDS + ("inf",), self.buckets):
+            if count:
+                buckets.append("<=%s:%d" % (bound, count))
+        return ("n=%d avg %.2f ms max %.2f ms %s"
+                % (self.count, self.total / self.count, self.max, " ".join(buckets)))
+
+# times the handlers that run on the main loop
+#
+# Handlers are labelled by a tuple like ("signal", interface,
+# member) and timed into a histogram per label. A heartbeat
+# timer notices when the loop as a whole did not get around
+# to it in time and names the slowest handler since the last
+# beat. Without timing, handlers are just called, timing
+# alone keeps the histograms without watching the loop.
+class Instrument(object):
+    def __init__(self):
+        self.timing = False
+        self.enabled = False
+        self.threshold = STALL_THRESHOLD
+        self.histograms = dict()
+        self.slowest = None
+        self.watchdog = None
+        self.due = None
+        self.profiler = None
+        self.profiles = 0
+
+    def enable(self, threshold=STALL_THRESHOLD):
+        self.timing = True
+        self.enabled = True
+        self.threshold = threshold
+        self.due = clock() + WATCHDOG_INTERVAL / 1000.0
+        self.watchdog = engine.timeout_add(WATCHDOG_INTERVAL, self.beat)
+        signal.signal(PROFILE_SIGNAL, self.toggle_profile)
+        LOG.info("instrumentation enabled, stall threshold %d ms" % threshold)
+
+    def run(self, label, path, fn, *args):
+        if not self.timing:
+            return fn(*args)
+        start = clock()
+        try:
+            return fn(*args)
+        finally:
+            ms = (clock() - start) * 1000
+            histogram = self.histograms.get(label)
+            if histogram == None:
+                histogram = self.histograms[label] = Histogram()
+            histogram.add(ms)
+            if self.enabled:
+                if self.slowest == None or ms > self.slowest[0]:
+                    self.slowest = (ms, label, path)
+                if ms > self.threshold:
+                    LOG.warning("%s on %s took %.0f ms" % (" ".join(label), path, ms))
+
+    def beat(self):
+        now = clock()
+        late = (now - self.due) * 1000
+        if late > self.threshold:
+            culprit = ""
+            if self.slowest != None:
+                ms, label, path = self.slowest
+                culprit = ", slowest was %s on %s with %.0f ms" % (" ".join(label), path, ms)
+            LOG.warning("main loop stalled for %.0f ms%s" % (late, culprit))
+        self.slowest = None
+        self.due = now + WATCHDOG_INTERVAL / 1000.0
+        return True
+
+    def toggle_profile(self, signum, frame):
+        if self.profiler == None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            LOG.warning("profiling started")
+            return
+        self.profiler.disable()
+        self.profiles += 1
+        path = profile_path(self.profiles)
+        if path == None:
+            LOG.warning("no private directory for profiles, dropping it")
+            self.profiler = None
+            return
+        try:
+            self.profiler.dump_stats(path)
+            LOG.warning("profile written to %s" % path)
+        except (IOError, OSError) as e:
+            LOG.warning("can not write profile to %s: %s" % (path, e))
+        self.profiler = None
+
+    def report(self):
+        for label in sorted(self.histograms.keys()):
+            LOG.info("%s: %s" % (" ".join(label), self.histograms[label].format()))
+
+instrument = Instrument()
@@ -0,0 +1,228 @@
+from __future__ import absolute_import
+
+import logging
+
+from collections import OrderedDict
+
+from nebel import engine
+
+LOG = logging.getLogger("nebel.notifications")
+
+NOTIFICATIONS = "org.freedesktop.Notifications"
+NOTIFICATIONS_PATH = "/org/freedesktop/Notifications"
+
+URGENCY_LOW = 0
+URGENCY_NORMAL = 1
+URGENCY_CRITICAL = 2
+
+# timeout for calls to the notification daemon in seconds
+NOTIFY_TIMEOUT = 5.0
+
+# grace period before we consider an expired notification
+# gone if the daemon does not tell us, in milliseconds
+NOTIFY_EXPIRY_SLACK = 5000
+
+# number of notifications to keep track of
+NOTIFY_MAX_IDS = 256
+
+client = None
+
+# asynchronous client for the notification daemon
+#
+# Notify calls never block. Updates to a notification whose
+# Notify call is still in flight are held back and sent with
+# the returned id as replaces_id once it arrives, so only
+# the latest content goes out. NotificationClosed keeps
+# track of notifications that went away on the daemon side,
+# those that expire or fall out of the table are dropped
+# without waiting for it. It is only taken from the unique
+# name that owns org.freedesktop.Notifications, anyone can
+# send a signal to us.
+class NotificationClient:
+    def __init__(self, bus, app_name, max_ids=NOTIFY_MAX_IDS):
+        self.bus = bus
+        self.app_name = app_name
+        self.max_ids = max_ids
+        # least recently shown first
+        self.ids = OrderedDict()
+        self.capabilities = None
+        self.sent = 0
+        self.failures = 0
+        self.dropped = 0
+        # unique name of the daemon once we know it
+        self.owner = None
+        self.sigowner = bus.add_signal_receiver(
+            self.name_owner_changed, signal_name="NameOwnerChanged",
+            dbus_interface=engine.DBUS, bus_name=engine.DBUS, path=engine.DBUS_PATH,
+            arg0=NOTIFICATIONS)
+        self.sigclosed = bus.add_signal_receiver(
+            self.notification_closed, signal_name="NotificationClosed",
+            dbus_interface=NOTIFICATIONS, path=NOTIFICATIONS_PATH, sender_keyword="sender")
+        # fails while the daemon is not running, NameOwnerChanged
+        # tells us once showing a notification started it
+        self.bus.call_async(engine.DBUS, engine.DBUS_PATH, engine.DBUS, "GetNameOwner", "s",
+                            (NOTIFICATIONS,), self.name_owned, lambda err: None,
+                            timeout=NOTIFY_TIMEOUT)
+        self.call("GetCapabilities", "", (), self.got_capabilities)
+
+    def name_owned(self, owner):
+        self.owner = str(owner)
+
+    def name_owner_changed(self, name, old, new):
+        LOG.debug("owner of %s changed from %r to %r" % (name, old, new))
+        self.owner = str(new) or None
+
+    def call(self, method, signature, args, reply, error=None):
+        if error == None:
+            error = lambda err: LOG.warning("%s failed: %s" % (method, err))
+        self.bus.call_async(NOTIFICATIONS, NOTIFICATIONS_PATH, NOTIFICATIONS,
+                            method, signature, args, reply, error,
+                            timeout=NOTIFY_TIMEOUT)
+
+    def got_capabilities(self, capabilities):
+        self.capabilities = set(map(str, capabilities))
+        LOG.info("notification daemon capabilities: %s"
+                 % ", ".join(sorted(self.capabilities)))
+
+    def has_capability(self, capability):
+        # assume the common case until we know
+        return self.capabilities == None or capability in self.capabilities
+
+    def show(self, n):
+        if n.inflight:
+            n.dirty = True
+            return
+        n.inflight = True
+        n.dirty = False
+        summary = n.summary
+        body = n.message
+        if body and not self.has_capability("body"):
+            summary = summary + " " + body.strip()
+            body = ""
+        hints = {"urgency": engine.byte(n.urgency)}
+        self.sent += 1
+        self.call("Notify", "susssasa{sv}i",
+                  (self.app_name, n.id, "", summary, body, [], hints, n.timeout),
+                  lambda id: self.shown(n, id),
+                  lambda err: self.failed(n, err))
+
+    def shown(self, n, id):
+        n.inflight = False
+        id = int(id)
+        self.ids.pop(n.id, None)
+        n.id = id
+        self.ids[id] = n
+        self.expire(n)
+        if n.closed:
+            self.close(n)
+        elif n.dirty:
+            self.show(n)
+        while len(self.ids) > self.max_ids:
+            old_id, old = self.ids.popitem(last=False)
+            LOG.debug("evicting notification %d" % old_id)
+            self.dropped += 1
+            self.drop(old)
+
+    def failed(self, n, err):
+        LOG.warning("Notify failed: %s" % err)
+        self.failures += 1
+        n.inflight = False
+        if n.closed:
+            self.close(n)
+        elif not n.id:
+            # never on screen, the next show starts over
+            n.closed = True
+        else:
+            # the screen still has what was there before, this
+            # content must not count as shown
+            n.summary = None
+            n.message = None
+
+    def close(self, n):
+        n.closed = True
+        if n.inflight or not n.id:
+            return
+        self.ids.pop(n.id, None)
+        self.unexpire(n)
+        self.call("CloseNotification", "u", (n.id,), lambda: None)
+
+    def expire(self, n):
+        self.unexpire(n)
+        if n.timeout > 0:
+            n.expiry = engine.timeout_add(n.timeout + NOTIFY_EXPIRY_SLACK, self.expired, n)
+
+    def unexpire(self, n):
+        if n.expiry != None:
+            engine.source_remove(n.expiry)
+            n.expiry = None
+
+    def expired(self, n):
+        n.expiry = None
+        if self.ids.get(n.id) is n:
+            LOG.debug("notification %d expired" % n.id)
+            del self.ids[n.id]
+            self.dropped += 1
+            self.drop(n)
+        return False
+
+    def drop(self, n):
+        self.unexpire(n)
+        n.closed = True
+        if n.closed_handler != None:
+            n.closed_handler(n)
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "failed": self.failures,
+            "dropped": self.dropped,
+            "tracked": len(self.ids),
+        }
+
+    def notification_closed(self, id, reason, sender=None):
+        if sender == None or sender != self.owner:
+            LOG.warning("dropping NotificationClosed from %s, not the owner of %s"
+                        % (sender, NOTIFICATIONS))
+            return
+        n = self.ids.pop(int(id), None)
+        if n != None:
+            LOG.debug("notification %d closed, reason %d" % (id, reason))
+            self.drop(n)
+
+# a notification, mostly compatible with notify2
+class Notification:
+    def __init__(self, summary, message=''):
+        self.id = 0
+        self.summary = summary
+        self.message = message
+        self.timeout = -1
+        self.urgency = URGENCY_NORMAL
+        self.inflight = False
+        self.dirty = False
+        self.closed = False
+        self.closed_handler = None
+        self.expiry = None
+
+    def update(self, summary, message=''):
+        self.summary = summary
+        self.message = message
+
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+
+    def set_urgency(self, urgency):
+        self.urgency = urgency
+
+    def show(self):
+        self.closed = False
+        client.show(self)
+
+    def close(self):
+        client.close(self)
+
+def init(app_name, bus=None):
+    global client
+    if bus == None:
+        bus = engine.session_bus()
+    client = NotificationClient(bus, app_name)
+    return client
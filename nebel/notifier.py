@@ -0,0 +1,297 @@
+from __future__ import absolute_import
+
+import logging
+
+from nebel import engine
+from nebel.engine import clock
+from nebel import notifications as notify
+from nebel.instrument import instrument
+
+LOG = logging.getLogger("nebel.notifier")
+
+# default coalescing window in milliseconds,
+# zero flushes once the main loop is idle
+NOTIFY_WINDOW = 0
+
+# longest updates to a key can hold it back in milliseconds,
+# counted from the first one, unless its window is longer
+NOTIFY_MAX_DELAY = 1000
+
+# dispatch lanes, most urgent first
+LANES = (notify.URGENCY_CRITICAL, notify.URGENCY_NORMAL, notify.URGENCY_LOW)
+
+LANE_NAMES = {
+    notify.URGENCY_CRITICAL: "critical",
+    notify.URGENCY_NORMAL: "normal",
+    notify.URGENCY_LOW: "low",
+}
+
+# rate limit per lane in notifications per second, None for unlimited
+LANE_RATES = {
+    notify.URGENCY_CRITICAL: None,
+    notify.URGENCY_NORMAL: 10,
+    notify.URGENCY_LOW: 4,
+}
+
+# notifications waiting for their lane beyond which they are
+# shown as one, so a burst does not trickle out for seconds
+LANE_MERGE_THRESHOLD = 8
+
+class PendingNotification:
+    def __init__(self, owner, name, posted):
+        self.owner = owner
+        self.name = name
+        self.posted = posted
+
+# owns the notification a lane shows for what it merged
+class MergedOwner:
+    def __init__(self, lane):
+        self.path = "merged-%s" % lane.name
+        self.key = (self.path, "merged")
+        self.notifs = dict()
+
+# notifications of one urgency that are ready to be shown
+class Lane:
+    def __init__(self, urgency, rate):
+        self.urgency = urgency
+        self.name = LANE_NAMES[urgency]
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = clock()
+        self.ready = list()
+        self.posted = 0
+        self.coalesced = 0
+        self.unchanged = 0
+        self.merged = 0
+        self.shown = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    # takes a token, returns the seconds to wait if there is none
+    def take(self, now):
+        if self.rate == None:
+            return 0
+        self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        return 0
+
+    def record(self, latency):
+        self.shown += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+# collects notifications and shows them in batches
+#
+# Notifications are keyed by their owner and name. Updates
+# to a key replace the pending content and push its flush
+# back by the window, so a burst of updates only renders the
+# last one. A steady stream of updates is still shown once
+# NOTIFY_MAX_DELAY has passed since the first.
+#
+# Keys that are due wait in a lane for their urgency, lanes
+# are served most urgent first within their rate limits.
+# Once more than LANE_MERGE_THRESHOLD are waiting, they are
+# merged into one notification that lists them all.
+# Critical notifications skip the window and are shown
+# immediately. Content that is already on screen is not
+# sent again.
+class Notifier:
+    def __init__(self):
+        self.pending = dict()
+        self.timers = dict()
+        self.lanes = dict()
+        self.mergers = dict()
+        for urgency in LANES:
+            self.lanes[urgency] = Lane(urgency, LANE_RATES[urgency])
+            self.mergers[urgency] = MergedOwner(self.lanes[urgency])
+        self.dispatcher = None
+        # passes notifications on instead of showing them if set
+        self.forward = None
+
+    def show(self, owner, name, summary, message, timeout, urgency,
+             window=NOTIFY_WINDOW):
+        if self.forward != None:
+            self.forward.show(owner.path, name, summary, message, timeout, urgency, window)
+            return
+        key = (owner.path, name)
+        lane = self.lanes[urgency]
+        lane.posted += 1
+        if self.showing(owner, name, summary, message, urgency):
+            LOG.debug("unchanged %s %s" % key)
+            lane.unchanged += 1
+            # an update in between is superseded
+            self.discard(key)
+            return
+        if key in self.pending:
+            LOG.debug("coalescing %s %s" % key)
+            lane.coalesced += 1
+            pending = self.pending[key]
+            if pending.urgency != urgency and key in self.lanes[pending.urgency].ready:
+                # move it to its new lane
+                self.lanes[pending.urgency].ready.remove(key)
+                lane.ready.append(key)
+        else:
+            pending = PendingNotification(owner, name, clock())
+            self.pending[key] = pending
+        pending.summary = summary
+        pending.message = message
+        pending.timeout = timeout
+        pending.urgency = urgency
+        if urgency == notify.URGENCY_CRITICAL:
+            if key in self.timers:
+                engine.source_remove(self.timers.pop(key))
+            if not key in lane.ready:
+                lane.ready.append(key)
+            self.dispatch()
+        elif not key in lane.ready:
+            if window > 0:
+                deadline = pending.posted + max(window, NOTIFY_MAX_DELAY) / 1000.0
+                delay = max(min(window, int((deadline - clock()) * 1000)), 0)
+                if key in self.timers:
+                    engine.source_remove(self.timers.pop(key))
+                self.timers[key] = engine.timeout_add(delay, instrument.run,
+                                                      ("timer", "Notifier.flush"), key[0],
+                                                      self.flush, key)
+            elif not key in self.timers:
+                self.timers[key] = engine.idle_add(instrument.run,
+                                                   ("timer", "Notifier.flush"), key[0],
+                                                   self.flush, key)
+
+    def cancel(self, owner, name):
+        if self.forward != None:
+            self.forward.cancel(owner.path, name)
+            return
+        self.discard((owner.path, name))
+        if name in owner.notifs:
+            owner.notifs.pop(name).close()
+
+    def discard(self, key):
+        if key in self.pending:
+            pending = self.pending.pop(key)
+            if key in self.timers:
+                engine.source_remove(self.timers.pop(key))
+            else:
+                self.lanes[pending.urgency].ready.remove(key)
+
+    # whether the notification is on screen with this content
+    def showing(self, owner, name, summary, message, urgency):
+        n = owner.notifs.get(name)
+        return (n != None and not n.closed and n.urgency == urgency
+                and n.summary == summary and n.message == message)
+
+    def flush(self, key):
+        del self.timers[key]
+        self.lanes[self.pending[key].urgency].ready.append(key)
+        self.dispatch()
+        return False
+
+    def redispatch(self):
+        self.dispatcher = None
+        self.dispatch()
+        return False
+
+    def dispatch(self):
+        now = clock()
+        wait = None
+        for urgency in LANES:
+            lane = self.lanes[urgency]
+            while lane.ready:
+                delay = lane.take(now)
+                if delay > 0:
+                    # once merging, later ones join until it is shown
+                    if (len(lane.ready) > LANE_MERGE_THRESHOLD
+                        or self.mergers[urgency].key in lane.ready):
+                        self.merge(lane)
+                    if wait == None or delay < wait:
+                        wait = delay
+                    break
+                key = lane.ready.pop(0)
+                pending = self.pending.pop(key)
+                LOG.debug("showing %s %s from lane %s after %.3fs"
+                          % (key + (lane.name, now - pending.posted)))
+                lane.record(now - pending.posted)
+                self.display(pending)
+        if wait != None and self.dispatcher == None:
+            self.dispatcher = engine.timeout_add(int(wait * 1000) + 1, instrument.run,
+                                                 ("timer", "Notifier.redispatch"), None,
+                                                 self.redispatch)
+
+    # replaces what waits in a lane by one notification
+    def merge(self, lane):
+        owner = self.mergers[lane.urgency]
+        key = owner.key
+        merged = self.pending.get(key)
+        if merged == None:
+            merged = PendingNotification(owner, "merged", clock())
+            # notifications it stands for
+            merged.count = 0
+            merged.message = ""
+            merged.timeout = 0
+            merged.urgency = lane.urgency
+            self.pending[key] = merged
+        lines = [merged.message]
+        count = 0
+        for other in lane.ready:
+            if other == key:
+                continue
+            count += 1
+            pending = self.pending.pop(other)
+            merged.posted = min(merged.posted, pending.posted)
+            merged.timeout = max(merged.timeout, pending.timeout)
+            lines.append(" ".join((pending.summary + " " + pending.message).split()))
+        if count:
+            LOG.debug("merged %d notifications in lane %s" % (count, lane.name))
+        lane.merged += count
+        merged.count += count
+        lane.ready = [key]
+        merged.summary = "%d notifications" % merged.count
+        merged.message = "\n".join([line for line in lines if line])
+
+    def display(self, pending):
+        owner = pending.owner
+        name = pending.name
+        if name in owner.notifs:
+            n = owner.notifs[name]
+            n.update(pending.summary, pending.message)
+        else:
+            n = notify.Notification(pending.summary, pending.message)
+            # the client keeps notifications after their owner is
+            # gone, so the handler must not keep the owner alive
+            notifs = owner.notifs
+            n.closed_handler = lambda n: self.closed(notifs, name, n)
+            owner.notifs[name] = n
+        n.set_timeout(pending.timeout)
+        n.set_urgency(pending.urgency)
+        n.show()
+
+    # the daemon closed it, on expiry or by the user
+    def closed(self, notifs, name, n):
+        if notifs.get(name) is n:
+            del notifs[name]
+
+    def stats(self):
+        stats = dict()
+        for lane in self.lanes.values():
+            depth = 0
+            for pending in self.pending.values():
+                if pending.urgency == lane.urgency:
+                    depth += 1
+            latency = 0.0
+            if lane.shown:
+                latency = lane.latency_total / lane.shown
+            stats[lane.name] = {
+                "depth": depth,
+                "posted": lane.posted,
+                "coalesced": lane.coalesced,
+                "unchanged": lane.unchanged,
+                "merged": lane.merged,
+                "shown": lane.shown,
+                "latency_avg": latency,
+                "latency_max": lane.latency_max,
+            }
+        return stats
+
+notifier = Notifier()
@@ -0,0 +1,158 @@
+from __future__ import absolute_import
+
+import os
+import logging
+
+import pyudev
+
+from nebel import engine
+from nebel.udev import watch_monitor
+from nebel.upower import *
+
+LOG = logging.getLogger("nebel.powersupply")
+
+SYSFS_POWER_SUPPLY = "/sys/class/power_supply"
+
+SUPPLY_TYPES = {
+    "Mains": DeviceType.ac.value,
+    "Battery": DeviceType.battery.value,
+}
+
+SUPPLY_STATES = {
+    "Charging": DeviceState.charging.value,
+    "Discharging": DeviceState.discharging.value,
+    "Full": DeviceState.charged.value,
+    "Not charging": DeviceState.pending_charge.value,
+}
+
+def read_attr(dir, name):
+    try:
+        with open(os.path.join(dir, name)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+def read_int(dir, name):
+    value = read_attr(dir, name)
+    if value == None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+# reads the attributes of a power supply into UPower device properties
+def read_supply(dir):
+    props = dict()
+    props["NativePath"] = os.path.basename(dir)
+    props["Type"] = SUPPLY_TYPES.get(read_attr(dir, "type"), DeviceType.unknown.value)
+    props["PowerSupply"] = read_attr(dir, "scope") != "Device"
+    props["Online"] = read_int(dir, "online") == 1
+    props["State"] = SUPPLY_STATES.get(read_attr(dir, "status"), DeviceState.unknown.value)
+    # batteries report either energy (uWh, uW) or charge (uAh, uA)
+    now = read_int(dir, "energy_now")
+    full = read_int(dir, "energy_full")
+    rate = read_int(dir, "power_now")
+    if now == None or full == None:
+        now = read_int(dir, "charge_now")
+        full = read_int(dir, "charge_full")
+        rate = read_int(dir, "current_now")
+    percent = read_int(dir, "capacity")
+    if percent != None:
+        props["Percentage"] = float(percent)
+    elif now != None and full:
+        props["Percentage"] = min(100.0 * now / full, 100.0)
+    props["TimeToEmpty"] = 0
+    props["TimeToFull"] = 0
+    if now != None and full != None and rate:
+        rate = abs(rate)
+        if props["State"] == DeviceState.discharging.value:
+            props["TimeToEmpty"] = int(3600 * now / rate)
+        if props["State"] == DeviceState.charging.value:
+            props["TimeToFull"] = int(3600 * max(full - now, 0) / rate)
+    return props
+
+# a power supply read from sysfs instead of UPower
+class SysfsPowerDevice(PowerDevice):
+    def __init__(self, monitor, path):
+        PowerDevice.__init__(self, monitor, path)
+        self.log = LOG
+
+    def connect_props_changed(self):
+        pass
+
+    def update(self):
+        DbusPropsObject.update(self)
+        raw = read_supply(self.path)
+        self.props_updated(self.apply_props(UPOWER_DEVICE, raw))
+
+# monitors power supplies through sysfs and power_supply uevents
+#
+# Feeds the same threshold logic as the UPower backend but
+# without D-Bus round trips and without waiting for UPower
+# to pick up changes. Pass a root directory to run against
+# a fake sysfs tree, and udev=False to do without uevents.
+class SysfsPowerMonitor(PowerMonitor):
+    SLOTS = ("root", "udev", "context", "monitor", "watch")
+
+    def __init__(self, root=SYSFS_POWER_SUPPLY, udev=True):
+        self.root = root
+        self.udev = udev
+        self.watch = None
+        PowerMonitor.__init__(self)
+        self.log = LOG
+
+    def added(self):
+        if self.udev:
+            self.context = pyudev.Context()
+            self.monitor = pyudev.Monitor.from_netlink(self.context)
+            self.monitor.filter_by("power_supply")
+            self.monitor.start()
+            self.watch = watch_monitor(self.monitor, self.dev_event)
+        self.enumerate()
+        DbusObject.added(self)
+
+    def removed(self):
+        if self.watch != None:
+            engine.source_remove(self.watch)
+            self.watch = None
+        for name in list(self.devs.keys()):
+            self.dev_removed(name)
+        DbusObject.removed(self)
+
+    def update(self):
+        DbusObject.update(self)
+        mains = list()
+        for dev in self.devs.values():
+            if dev.Type == DeviceType.ac:
+                mains.append(dev.Online)
+        raw = {"OnBattery": bool(mains) and not any(mains)}
+        self.props_updated(self.apply_props(UPOWER, raw))
+
+    def enumerate(self):
+        try:
+            names = sorted(os.listdir(self.root))
+        except OSError as e:
+            LOG.warning("can not enumerate %s: %s" % (self.root, e))
+            names = list()
+        self.enumerated([os.path.join(self.root, name) for name in names])
+
+    def dev_added(self, path):
+        if not path in self.devs:
+            self.devs[path] = SysfsPowerDevice(self, path)
+            self.devs[path].added()
+
+    def dev_event(self, action, device):
+        path = os.path.join(self.root, device.sys_name)
+        LOG.debug("event %s on %s" % (action, path))
+        if action == 'add':
+            self.dev_added(path)
+        elif action == 'change':
+            if path in self.devs:
+                self.devs[path].update()
+            else:
+                self.dev_added(path)
+        elif action == 'remove':
+            self.dev_removed(path)
+        if self.present:
+            self.update()
@@ -0,0 +1,23 @@
+from __future__ import absolute_import
+
+# renders notification text in sections
+#
+# A section is rendered from its inputs and kept until they
+# change, so a message over many devices only formats what
+# changed since the last time. Sections are cached by key,
+# owners discard the keys of things that went away.
+class Renderer(object):
+    __slots__ = ("sections",)
+
+    def __init__(self):
+        self.sections = dict()
+
+    def section(self, key, render, *inputs):
+        entry = self.sections.get(key)
+        if entry == None or entry[0] != inputs:
+            entry = (inputs, render(*inputs))
+            self.sections[key] = entry
+        return entry[1]
+
+    def discard(self, key):
+        self.sections.pop(key, None)
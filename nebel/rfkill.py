@@ -0,0 +1,157 @@
+from __future__ import absolute_import
+
+import os
+import fcntl
+import errno
+import struct
+import logging
+
+from nebel import engine
+from nebel.urfkill import *
+
+LOG = logging.getLogger("nebel.rfkill")
+
+RFKILL_DEV = "/dev/rfkill"
+SYSFS_RFKILL = "/sys/class/rfkill"
+
+# struct rfkill_event: idx, type, op, soft, hard
+#
+# Newer kernels append fields, but they only hand them
+# out to readers that ask for more than this.
+RFKILL_EVENT = "=IBBBB"
+RFKILL_EVENT_SIZE = struct.calcsize(RFKILL_EVENT)
+
+RFKILL_OP_ADD = 0
+RFKILL_OP_DEL = 1
+RFKILL_OP_CHANGE = 2
+RFKILL_OP_CHANGE_ALL = 3
+
+RFKILL_TYPES = {
+    1: "wlan",
+    2: "bluetooth",
+    3: "uwb",
+    4: "wimax",
+    5: "wwan",
+    6: "gps",
+    7: "fm",
+    8: "nfc",
+}
+
+def read_name(root, idx, type):
+    try:
+        with open(os.path.join(root, "rfkill%d" % idx, "name")) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return RFKILL_TYPES.get(type, "rfkill%d" % idx)
+
+# an rfkill switch driven by kernel events
+class KernelRfkillDevice(RfkillDevice):
+    SLOTS = ("type",)
+
+    def __init__(self, path, type):
+        RfkillDevice.__init__(self, path)
+        self.log = LOG
+        self.type = type
+
+    def connect_props_changed(self):
+        pass
+
+    def update(self):
+        pass
+
+    def event(self, raw):
+        self.props_updated(self.apply_props(URFKILL_DEVICE, raw))
+
+# monitors rfkill switches through /dev/rfkill
+#
+# Reads the kernel's fixed-size event records from a GLib
+# IO watch and decodes them straight into device state,
+# so there is no daemon and no IPC involved. Any readable
+# fd carrying the same records will do, like a pipe
+# replaying a recording. If /dev/rfkill can not be opened
+# the monitor is not present and watches nothing.
+class KernelRfkillMonitor(RfkillMonitor):
+    SLOTS = ("fd", "root", "watch", "buffer")
+
+    def __init__(self, fd=None, root=SYSFS_RFKILL):
+        self.fd = fd
+        self.root = root
+        self.watch = None
+        self.buffer = b""
+        RfkillMonitor.__init__(self)
+        self.log = LOG
+
+    def added(self):
+        if self.fd == None:
+            try:
+                self.fd = os.open(RFKILL_DEV, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError as e:
+                LOG.warning("can not open %s: %s" % (RFKILL_DEV, e))
+                return
+        else:
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.watch = engine.io_add_watch(self.fd, engine.IO_IN | engine.IO_HUP | engine.IO_ERR,
+                                         self.readable)
+        DbusObject.added(self)
+
+    def removed(self):
+        self.close()
+        for name in list(self.devs.keys()):
+            self.dev_removed(name)
+        DbusObject.removed(self)
+
+    def detach(self):
+        self.close()
+        RfkillMonitor.detach(self)
+
+    def close(self):
+        if self.watch != None:
+            engine.source_remove(self.watch)
+            self.watch = None
+        if self.fd != None:
+            os.close(self.fd)
+            self.fd = None
+
+    def readable(self, fd, condition):
+        try:
+            data = os.read(fd, RFKILL_EVENT_SIZE - len(self.buffer))
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            LOG.warning("can not read rfkill events: %s" % e)
+            self.watch = None
+            self.close()
+            return False
+        if not data:
+            LOG.info("end of rfkill events")
+            self.watch = None
+            self.close()
+            return False
+        self.buffer = self.buffer + data
+        if len(self.buffer) == RFKILL_EVENT_SIZE:
+            record = struct.unpack(RFKILL_EVENT, self.buffer)
+            self.buffer = b""
+            self.event(*record)
+        return True
+
+    def event(self, idx, type, op, soft, hard):
+        LOG.debug("event op %d idx %d type %d soft %d hard %d"
+                  % (op, idx, type, soft, hard))
+        path = os.path.join(self.root, "rfkill%d" % idx)
+        raw = {"soft": soft != 0, "hard": hard != 0}
+        if op == RFKILL_OP_ADD:
+            if not path in self.devs:
+                raw["name"] = read_name(self.root, idx, type)
+                self.devs[path] = KernelRfkillDevice(path, type)
+                self.devs[path].added()
+            self.devs[path].event(raw)
+        elif op == RFKILL_OP_DEL:
+            self.dev_removed(path)
+        elif op == RFKILL_OP_CHANGE:
+            if path in self.devs:
+                self.devs[path].event(raw)
+        elif op == RFKILL_OP_CHANGE_ALL:
+            for dev in self.devs.values():
+                if type == 0 or dev.type == type:
+                    dev.event(raw)
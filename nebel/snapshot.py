@@ -0,0 +1,146 @@
+from __future__ import absolute_import
+
+import os
+import stat
+import json
+import errno
+import logging
+
+from nebel import engine
+
+LOG = logging.getLogger("nebel.snapshot")
+
+# delay for writing the snapshot after changes in milliseconds
+SNAPSHOT_DELAY = 2000
+
+# creates a directory only we can use, or checks that it is one
+def private_dir(path):
+    try:
+        try:
+            os.mkdir(path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+            LOG.warning("%s is not a directory of ours, not using it" % path)
+            return False
+        if stat.S_IMODE(st.st_mode) & 0o077:
+            # older versions left it readable
+            os.chmod(path, 0o700)
+    except (IOError, OSError) as e:
+        LOG.warning("can not use %s: %s" % (path, e))
+        return False
+    return True
+
+# directory for our state and profiles, None if there is none
+#
+# Without XDG_RUNTIME_DIR it is below /tmp, where someone
+# else may have created it first to feed us state or read
+# ours. Each directory on the way that is not ours and
+# private to us makes it unusable.
+def runtime_dir():
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        dirs = [os.path.join(runtime, "nebel")]
+    else:
+        base = "/tmp/nebel-%d" % os.getuid()
+        dirs = [base, os.path.join(base, "nebel")]
+    for path in dirs:
+        if not private_dir(path):
+            return None
+    return dirs[-1]
+
+def snapshot_path(name="state"):
+    runtime = runtime_dir()
+    if runtime == None:
+        return None
+    return os.path.join(runtime, name + ".json")
+
+# last known state of objects across restarts
+#
+# Objects that take part restore their state when they are
+# added, so the first update after a restart only reports
+# what changed while we were down. The file only holds the
+# objects that are present or whose service went away.
+class Snapshot:
+    def __init__(self):
+        self.path = None
+        self.state = dict()
+        self.released = dict()
+        self.objects = dict()
+        self.timer = None
+
+    def load(self, name="state"):
+        path = snapshot_path(name)
+        if path == None:
+            LOG.warning("no private directory for snapshots, not keeping any")
+            return
+        self.path = path
+        try:
+            with open(path) as f:
+                self.state = json.load(f)
+            LOG.info("loaded state of %d objects from %s" % (len(self.state), path))
+        except (IOError, OSError, ValueError) as e:
+            LOG.info("no usable snapshot in %s: %s" % (path, e))
+            self.state = dict()
+
+    def restore(self, obj):
+        self.objects[obj.path] = obj
+        state = self.state.pop(obj.path, None)
+        state = self.released.pop(obj.path, state)
+        if state != None:
+            LOG.debug("restoring %s" % obj.path)
+            obj.restore(state)
+
+    def changed(self, obj):
+        if obj.path in self.objects:
+            self.schedule()
+
+    def forget(self, obj):
+        if self.objects.get(obj.path) is obj:
+            del self.objects[obj.path]
+            self.schedule()
+
+    # state of the objects below path that were not restored,
+    # by path, once the service told us about all it has
+    def leftovers(self, path):
+        gone = dict()
+        for table in (self.state, self.released):
+            for key in list(table.keys()):
+                if key.startswith(path + "/"):
+                    gone[key] = table.pop(key)
+        return gone
+
+    # keeps the state for when the object comes back
+    def release(self, obj):
+        if self.objects.get(obj.path) is obj:
+            del self.objects[obj.path]
+            if obj.init:
+                self.released[obj.path] = obj.snapshot()
+
+    def schedule(self):
+        if self.path != None and self.timer == None:
+            self.timer = engine.timeout_add(SNAPSHOT_DELAY, self.flush)
+
+    def flush(self):
+        self.timer = None
+        self.save()
+        return False
+
+    def save(self):
+        if self.path == None:
+            return
+        state = dict(self.released)
+        for path, obj in self.objects.items():
+            if obj.init:
+                state[path] = obj.snapshot()
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(state, f, separators=(",", ":"))
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            LOG.warning("can not save snapshot to %s: %s" % (self.path, e))
+
+snapshot = Snapshot()
@@ -0,0 +1,158 @@
+from __future__ import absolute_import
+
+import logging
+
+try:
+    import dbus
+    import dbus.service
+except ImportError:
+    # only the glib engine publishes stats
+    dbus = None
+
+import nebel.dbus
+from nebel import engine
+from nebel import notifications as notify
+from nebel.instrument import instrument
+from nebel.notifier import notifier
+
+LOG = logging.getLogger("nebel.stats")
+
+STATS = "org.nebel.Stats"
+STATS_PATH = "/org/nebel/Stats"
+
+# metrics by name, with their type and help text
+METRICS = (
+    ("nebel_dbus_calls_total", "counter", "D-Bus calls issued by service"),
+    ("nebel_dbus_calls_coalesced_total", "counter", "D-Bus calls joined to one in flight by service"),
+    ("nebel_dbus_signals_total", "counter", "D-Bus signals received by interface"),
+    ("nebel_dbus_signals_rejected_total", "counter", "D-Bus signals dropped for not coming from their service"),
+    ("nebel_objects", "gauge", "objects tracked by monitor"),
+    ("nebel_udev_events_total", "counter", "udev events received"),
+    ("nebel_udev_events_filtered_total", "counter", "udev events ignored"),
+    ("nebel_notifications_posted_total", "counter", "notifications posted by lane"),
+    ("nebel_notifications_coalesced_total", "counter", "notifications replaced while pending by lane"),
+    ("nebel_notifications_unchanged_total", "counter", "notifications skipped as already shown by lane"),
+    ("nebel_notifications_merged_total", "counter", "notifications shown merged with others by lane"),
+    ("nebel_notifications_pending", "gauge", "notifications waiting to be shown by lane"),
+    ("nebel_notifications_sent_total", "counter", "notifications sent to the daemon"),
+    ("nebel_notifications_failed_total", "counter", "notifications the daemon refused"),
+    ("nebel_notifications_dropped_total", "counter", "notifications expired or evicted without being closed"),
+    ("nebel_handler_calls_total", "counter", "main loop handler runs"),
+    ("nebel_handler_seconds_total", "counter", "time spent in main loop handlers"),
+    ("nebel_worker_restarts_total", "counter", "worker processes restarted by monitor"),
+)
+
+# collects the counters nebel keeps anyway
+#
+# Samples are (metric, labels, value) with the labels as a
+# dict. Monitors are those of the registry and any others
+# that run on their own, like the sysfs and kernel backends.
+# With workers, the front-end only has its own counters and
+# those of the supervisor.
+class Stats(object):
+    def __init__(self, registry=None, udev=None, monitors=(), supervisor=None):
+        self.registry = registry
+        self.udev = udev
+        self.monitors = list(monitors)
+        self.supervisor = supervisor
+
+    def samples(self):
+        samples = list()
+        if nebel.dbus.caller != None:
+            for dest, count in nebel.dbus.caller.calls.items():
+                samples.append(("nebel_dbus_calls_total", {"service": dest}, count))
+            for dest, count in nebel.dbus.caller.coalesced.items():
+                samples.append(("nebel_dbus_calls_coalesced_total", {"service": dest}, count))
+        if nebel.dbus.router != None:
+            for iface, count in nebel.dbus.router.received.items():
+                samples.append(("nebel_dbus_signals_total", {"interface": iface}, count))
+            for dest, count in nebel.dbus.router.rejected.items():
+                samples.append(("nebel_dbus_signals_rejected_total", {"service": dest}, count))
+        monitors = list(self.monitors)
+        if self.registry != None:
+            monitors.extend(self.registry.monitors.values())
+        for monitor in monitors:
+            for kind, count in monitor.stats().items():
+                samples.append(("nebel_objects",
+                                {"monitor": type(monitor).__name__, "kind": kind}, count))
+        if self.udev != None:
+            udev = self.udev.stats()
+            samples.append(("nebel_objects", {"monitor": "UDevMonitor", "kind": "devices"},
+                            udev["devices"]))
+            samples.append(("nebel_udev_events_total", {}, udev["received"]))
+            samples.append(("nebel_udev_events_filtered_total", {}, udev["filtered"]))
+        for lane, stats in notifier.stats().items():
+            for key in ("posted", "coalesced", "unchanged", "merged"):
+                samples.append(("nebel_notifications_%s_total" % key, {"lane": lane}, stats[key]))
+            samples.append(("nebel_notifications_pending", {"lane": lane}, stats["depth"]))
+        if notify.client != None:
+            client = notify.client.stats()
+            for key in ("sent", "failed", "dropped"):
+                samples.append(("nebel_notifications_%s_total" % key, {}, client[key]))
+        for label, histogram in instrument.histograms.items():
+            handler = " ".join(label)
+            samples.append(("nebel_handler_calls_total", {"handler": handler}, histogram.count))
+            samples.append(("nebel_handler_seconds_total", {"handler": handler},
+                            histogram.total / 1000))
+        if self.supervisor != None:
+            for name, restarts in self.supervisor.stats().items():
+                samples.append(("nebel_worker_restarts_total", {"worker": name}, restarts))
+        return samples
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def sample_name(metric, labels):
+    if not labels:
+        return metric
+    return "%s{%s}" % (metric, ",".join("%s=\"%s\"" % (key, escape(labels[key]))
+                                        for key in sorted(labels)))
+
+# formats samples in the Prometheus text format
+def prometheus(samples):
+    by_metric = dict()
+    for metric, labels, value in samples:
+        by_metric.setdefault(metric, list()).append((labels, value))
+    lines = list()
+    for metric, kind, help in METRICS:
+        if not metric in by_metric:
+            continue
+        lines.append("# HELP %s %s" % (metric, help))
+        lines.append("# TYPE %s %s" % (metric, kind))
+        for labels, value in sorted(by_metric[metric], key=lambda sample: sorted(sample[0].items())):
+            lines.append("%s %s" % (sample_name(metric, labels), repr(float(value))))
+    return "\n".join(lines) + "\n"
+
+if dbus != None:
+    # publishes the stats on the session bus
+    class StatsService(dbus.service.Object):
+        def __init__(self, bus, name, stats):
+            dbus.service.Object.__init__(self, bus, STATS_PATH)
+            # the name is released with the last reference to it
+            self.busname = name
+            self.stats = stats
+
+        @dbus.service.method(STATS, in_signature="", out_signature="a(sa{ss}d)")
+        def GetStats(self):
+            return [(metric, dict((key, str(label)) for key, label in labels.items()), float(value))
+                    for metric, labels, value in self.stats.samples()]
+
+        @dbus.service.method(STATS, in_signature="", out_signature="s")
+        def GetMetrics(self):
+            return prometheus(self.stats.samples())
+
+# exports the stats, None if another nebel has the name
+def export(stats, bus=None):
+    if engine.current().name != "glib":
+        LOG.info("publishing stats needs the glib engine")
+        return None
+    if bus == None:
+        bus = engine.session_bus()
+    try:
+        name = dbus.service.BusName(STATS, bus, do_not_queue=True)
+    except dbus.exceptions.NameExistsException:
+        LOG.warning("%s is taken, not publishing stats" % STATS)
+        return None
+    # handler totals are cheap enough to keep
+    instrument.timing = True
+    return StatsService(bus, name, stats)
@@ -0,0 +1,382 @@
+from __future__ import absolute_import
+
+import json
+import time
+import logging
+
+from collections import deque
+
+try:
+    import dbus
+except ImportError:
+    # values from other engines are plain already
+    dbus = None
+
+from nebel import engine
+from nebel.engine import clock
+from nebel.notifier import notifier
+
+LOG = logging.getLogger("nebel.trace")
+
+TRACE_VERSION = 2
+
+# interval for writing out recorded events in milliseconds
+TRACE_FLUSH_INTERVAL = 1000
+
+# longest pause replayed in real time in seconds,
+# sessions appended to the same trace follow each other
+TRACE_MAX_GAP = 10.0
+
+# interval for checking whether a replay has settled in milliseconds
+REPLAY_SETTLE_INTERVAL = 100
+
+# converts D-Bus values to what JSON can hold
+#
+# Byte arrays become strings with one character per byte,
+# which is how nebel treats them anyway.
+def plain(value):
+    if dbus != None and isinstance(value, dbus.Boolean):
+        return bool(value)
+    if dbus != None and isinstance(value, dbus.ByteArray):
+        if not isinstance(value, str):
+            return value.decode("latin-1")
+        return str(value)
+    if isinstance(value, dict):
+        return dict((str(key), plain(value[key])) for key in value)
+    if isinstance(value, (list, tuple)):
+        return [plain(item) for item in value]
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        return int(value)
+    return value
+
+def encode(value):
+    return json.dumps(value, separators=(",", ":"))
+
+def call_key(dest, path, iface, method, args):
+    return (dest, str(path), iface, method, encode(plain(list(args))))
+
+# appends incoming events to a trace file
+#
+# One JSON array per line, starting with the kind of event
+# and its time:
+#
+#   ["h", time, version]                           start of a session
+#   ["s", time, path, interface, member, args, sender]  signal
+#   ["r", time, dest, path, iface, method, args, ret]  method reply
+#   ["u", time, action, device]                    udev event
+#
+# Replies are recorded so a replay can answer the calls
+# nebel makes without the services being around. Senders
+# are recorded since nebel only takes signals from the
+# owners of its services, traces of version 1 have none.
+class Recorder(object):
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a")
+        self.events = 0
+        self.timer = None
+        self.write(["h", round(time.time(), 3), TRACE_VERSION])
+
+    def write(self, event):
+        self.file.write(encode(event) + "\n")
+        self.events += 1
+        if self.timer == None:
+            self.timer = engine.timeout_add(TRACE_FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        self.timer = None
+        self.file.flush()
+        return False
+
+    def close(self):
+        if self.timer != None:
+            engine.source_remove(self.timer)
+            self.timer = None
+        self.file.close()
+        LOG.info("recorded %d events to %s" % (self.events, self.path))
+
+    def signal(self, key, args, sender):
+        path, iface, member = key
+        self.write(["s", round(time.time(), 3), path, iface, member, plain(args), sender])
+
+    def reply(self, key, ret):
+        dest, path, iface, method, args = key
+        self.write(["r", round(time.time(), 3), dest, path, iface, method,
+                    plain(list(args)), plain(list(ret))])
+
+    def udev(self, action, device):
+        self.write(["u", round(time.time(), 3), action, {
+            "device_path": device.device_path,
+            "sys_name": device.sys_name,
+            "subsystem": device.subsystem,
+            "device_type": device.device_type,
+            "driver": device.driver,
+            "tags": list(device.tags),
+        }])
+
+# a udev device as recorded
+class ReplayDevice(object):
+    def __init__(self, action, attrs):
+        self.action = action
+        self.device_path = attrs.get("device_path")
+        self.sys_name = attrs.get("sys_name")
+        self.subsystem = attrs.get("subsystem")
+        self.device_type = attrs.get("device_type")
+        self.driver = attrs.get("driver")
+        self.tags = attrs.get("tags", [])
+
+# a signal as the message filter sees it
+class ReplayMessage(object):
+    def __init__(self, path, iface, member, args, sender):
+        self.path = path
+        self.iface = iface
+        self.member = member
+        self.args = args
+        self.sender = sender
+
+    def get_type(self):
+        return engine.MESSAGE_TYPE_SIGNAL
+
+    def get_path(self):
+        return self.path
+
+    def get_interface(self):
+        return self.iface
+
+    def get_member(self):
+        return self.member
+
+    def get_sender(self):
+        return self.sender
+
+    def get_args_list(self, byte_arrays=False):
+        return list(self.args)
+
+class ReplayError(Exception):
+    pass
+
+class ReplayReceiver(object):
+    def __init__(self, bus, handler, member, iface, path, arg0, sender, sender_keyword):
+        self.bus = bus
+        self.handler = handler
+        self.member = member
+        self.iface = iface
+        self.path = path
+        self.arg0 = arg0
+        self.sender = sender
+        self.sender_keyword = sender_keyword
+
+    def matches(self, path, iface, member, args, sender):
+        return ((self.member == None or self.member == member)
+                and (self.iface == None or self.iface == iface)
+                and (self.path == None or self.path == path)
+                and (self.arg0 == None or (args and args[0] == self.arg0))
+                and (self.sender == None or self.sender == sender))
+
+    def receive(self, args, sender):
+        if self.sender_keyword != None:
+            self.handler(*args, **{self.sender_keyword: sender})
+        else:
+            self.handler(*args)
+
+    def remove(self):
+        if self in self.bus.receivers:
+            self.bus.receivers.remove(self)
+
+# stands in for the system bus during a replay
+#
+# Signals from the trace go through the message filters and
+# signal receivers like they would on the bus. Calls are
+# answered with the recorded replies in the order they were
+# recorded, calls without one fail.
+class ReplayBus(object):
+    def __init__(self):
+        self.filters = list()
+        self.receivers = list()
+        self.replies = dict()
+        self.calls = 0
+        self.missed = 0
+
+    def add_message_filter(self, filter):
+        self.filters.append(filter)
+
+    def add_match_string_non_blocking(self, rule):
+        pass
+
+    def remove_match_string_non_blocking(self, rule):
+        pass
+
+    def add_signal_receiver(self, handler, signal_name=None, dbus_interface=None,
+                            bus_name=None, path=None, arg0=None, sender_keyword=None,
+                            **kwargs):
+        receiver = ReplayReceiver(self, handler, signal_name, dbus_interface, path, arg0,
+                                  bus_name, sender_keyword)
+        self.receivers.append(receiver)
+        return receiver
+
+    def recorded(self, dest, path, iface, method, args, ret):
+        key = call_key(dest, path, iface, method, args)
+        self.replies.setdefault(key, deque()).append(ret)
+
+    def call_async(self, dest, path, iface, method, signature, args,
+                   reply, error, timeout=None, byte_arrays=False):
+        self.calls += 1
+        key = call_key(dest, path, iface, method, args)
+        replies = self.replies.get(key)
+        if replies:
+            engine.idle_add(self.answer, reply, replies.popleft())
+        else:
+            self.missed += 1
+            err = ReplayError("no reply to %s.%s on %s in trace" % (iface, method, path))
+            engine.idle_add(self.answer, error, [err])
+
+    def answer(self, handler, ret):
+        handler(*ret)
+        return False
+
+    def emit(self, path, iface, member, args, sender=None):
+        message = ReplayMessage(path, iface, member, args, sender)
+        for filter in self.filters:
+            filter(self, message)
+        for receiver in list(self.receivers):
+            if receiver.matches(path, iface, member, args, sender):
+                receiver.receive(args, sender)
+
+# unique name of the notification daemon during a replay
+NOTIFICATION_LOG_NAME = ":replay.1"
+
+# stands in for the notification daemon during a replay
+#
+# Writes every notification that is sent as a JSON array of
+# summary, body and urgency per line, so the output of two
+# replays can be compared.
+class NotificationLog(object):
+    def __init__(self, out):
+        self.out = out
+        self.last_id = 0
+        self.shown = 0
+
+    def add_signal_receiver(self, handler, **kwargs):
+        return None
+
+    def call_async(self, dest, path, iface, method, signature, args,
+                   reply, error, timeout=None):
+        if method == "Notify":
+            app_name, id, icon, summary, body, actions, hints, expire = args
+            if not id:
+                self.last_id += 1
+                id = self.last_id
+            self.shown += 1
+            urgency = hints.get("urgency", 1)
+            if isinstance(urgency, tuple):
+                # variants from the asyncio engine are (signature, value)
+                urgency = urgency[1]
+            self.out.write(encode([summary, body, int(urgency)]) + "\n")
+            self.out.flush()
+            engine.idle_add(self.answer, reply, (id,))
+        elif method == "GetCapabilities":
+            engine.idle_add(self.answer, reply, (["body"],))
+        elif method == "GetNameOwner":
+            engine.idle_add(self.answer, reply, (NOTIFICATION_LOG_NAME,))
+        else:
+            engine.idle_add(self.answer, reply, ())
+
+    def answer(self, reply, ret):
+        reply(*ret)
+        return False
+
+# feeds a trace back through the monitors
+#
+# With a speed of 1.0 events follow each other as recorded,
+# higher speeds compress time, 0 replays as fast as possible.
+# Once the trace is done and the notifier has shown what was
+# pending, done is called.
+class Replayer(object):
+    def __init__(self, path, bus, udev=None, speed=1.0, done=None):
+        self.path = path
+        self.bus = bus
+        self.udev = udev
+        self.speed = speed
+        self.done = done
+        self.events = deque()
+        self.replayed = 0
+        self.start = None
+        self.timer = None
+        self.load()
+
+    def load(self):
+        stamp = None
+        offset = 0.0
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    LOG.warning("skipping broken line in %s" % self.path)
+                    continue
+                kind = event[0]
+                if kind == "r":
+                    self.bus.recorded(*event[2:])
+                    continue
+                if kind == "h":
+                    if event[2] < TRACE_VERSION:
+                        LOG.warning("%s has version %d, its signals have no sender "
+                                    "and are dropped" % (self.path, event[2]))
+                    continue
+                # time since the start of the replay
+                if stamp != None:
+                    offset += min(max(event[1] - stamp, 0.0), TRACE_MAX_GAP)
+                stamp = event[1]
+                self.events.append((offset, event))
+        LOG.info("loaded %d events from %s" % (len(self.events), self.path))
+
+    def run(self):
+        self.start = clock()
+        self.timer = engine.idle_add(self.step)
+
+    def step(self):
+        self.timer = None
+        if self.speed > 0:
+            elapsed = (clock() - self.start) * self.speed
+            while self.events and self.events[0][0] <= elapsed:
+                self.dispatch(self.events.popleft()[1])
+            if self.events:
+                delay = (self.events[0][0] - elapsed) / self.speed
+                self.timer = engine.timeout_add(int(delay * 1000) + 1, self.step)
+        elif self.events:
+            self.dispatch(self.events.popleft()[1])
+            if self.events:
+                self.timer = engine.idle_add(self.step)
+        if not self.events:
+            elapsed = clock() - self.start
+            rate = 0.0
+            if elapsed > 0:
+                rate = self.replayed / elapsed
+            LOG.info("replayed %d events in %.3fs, %.0f events/s, %d of %d calls unanswered"
+                     % (self.replayed, elapsed, rate, self.bus.missed, self.bus.calls))
+            self.timer = engine.timeout_add(REPLAY_SETTLE_INTERVAL, self.settle)
+        return False
+
+    def settle(self):
+        if notifier.pending:
+            return True
+        self.timer = None
+        if self.done != None:
+            self.done()
+        return False
+
+    def dispatch(self, event):
+        self.replayed += 1
+        kind = event[0]
+        try:
+            if kind == "s":
+                self.bus.emit(*event[2:])
+            elif kind == "u" and self.udev != None:
+                action, attrs = event[2:]
+                self.udev.dev_event(action, ReplayDevice(action, attrs))
+        except Exception:
+            LOG.exception("replaying %r failed" % (event,))
@@ -2,39 +2,130 @@ from __future__ import absolute_import
 
 import logging
 
+from collections import OrderedDict
+
 import pyudev
-import pyudev.glib
+
+from nebel import engine
+from nebel.instrument import instrument
 
 LOG = logging.getLogger("nebel.udev")
 
-class UDevDevice:
+# subsystems to subscribe to, as (subsystem, device type or None)
+#
+# These become socket filters on the netlink socket, so
+# events for anything else never wake us up. None
+# subscribes to everything. Block devices include their
+# partitions, which come and go on their own.
+UDEV_SUBSYSTEMS = (
+    ("block", None),
+    ("usb", "usb_device"),
+    ("power_supply", None),
+    ("rfkill", None),
+)
+
+# tags to subscribe to, events must carry one of them
+UDEV_TAGS = ()
+
+# number of devices to keep track of
+UDEV_MAX_DEVICES = 256
+
+# parses SUBSYSTEM[:DEVTYPE] as given on the command line
+def subsystem_filter(text):
+    subsystem, sep, device_type = text.partition(":")
+    return (subsystem, device_type or None)
+
+# calls handler with the action and device of every event
+#
+# Watches the netlink socket of a started monitor on the
+# event loop of the engine. Returns the id of the watch.
+def watch_monitor(monitor, handler):
+    def readable(fd, condition):
+        device = monitor.poll(timeout=0)
+        while device != None:
+            handler(device.action, device)
+            device = monitor.poll(timeout=0)
+        return True
+    return engine.io_add_watch(monitor.fileno(), engine.IO_IN, readable)
+
+class UDevDevice(object):
+    __slots__ = ("path",)
+
     def __init__(self, path):
         self.path = path
 
     def added(self, device):
-        LOG.info("dev add %s" % device.device_path)
+        LOG.debug("dev add %s" % device.device_path)
         self.update(device)
 
     def update(self, device):
-        LOG.info("dev upd %s type %s subsystem %s driver %s" %
-                 (device.device_path, device.device_type,
-                  device.subsystem, device.driver))
+        LOG.debug("dev upd %s type %s subsystem %s driver %s" %
+                  (device.device_path, device.device_type,
+                   device.subsystem, device.driver))
 
     def removed(self, device):
-        LOG.info("dev rem %s" % device.device_path)
+        LOG.debug("dev rem %s" % device.device_path)
 
 class UDevMonitor:
-    def __init__(self):
-        self.devs = dict()
+    def __init__(self, subsystems=UDEV_SUBSYSTEMS, tags=UDEV_TAGS,
+                 max_devices=UDEV_MAX_DEVICES, listen=True):
+        self.subsystems = subsystems
+        self.tags = tags
+        self.max_devices = max_devices
+        # least recently seen first
+        self.devs = OrderedDict()
+        self.received = 0
+        self.filtered = 0
+        self.evicted = 0
+        # records incoming events if set
+        self.tracer = None
+        self.watch = None
+        if listen:
+            self.listen()
+
+    # events are fed to dev_event by hand otherwise
+    def listen(self):
+        subsystems = self.subsystems
+        tags = self.tags
         self.context = pyudev.Context()
         self.monitor = pyudev.Monitor.from_netlink(self.context)
-        self.observer = pyudev.glib.GUDevMonitorObserver(self.monitor)
-        self.observer.connect('device-event', self.dev_event)
+        if subsystems != None:
+            for subsystem, device_type in subsystems:
+                self.monitor.filter_by(subsystem, device_type)
+        for tag in tags:
+            self.monitor.filter_by_tag(tag)
         self.monitor.start()
+        self.watch = watch_monitor(self.monitor, self.dev_event)
+
+    # events the socket filters let through anyway
+    def matches(self, device):
+        if self.subsystems != None:
+            for subsystem, device_type in self.subsystems:
+                if (device.subsystem == subsystem
+                    and (device_type == None or device.device_type == device_type)):
+                    break
+            else:
+                return False
+        if self.tags:
+            for tag in self.tags:
+                if tag in device.tags:
+                    break
+            else:
+                return False
+        return True
+
+    def dev_event(self, action, device):
+        instrument.run(("udev", action), device.device_path, self.dev_handle, action, device)
 
-    def dev_event(self, observer, action, device):
+    def dev_handle(self, action, device):
         LOG.debug('event {0} on type {1} device {2}'
                   .format(device.action, device.device_type, device.device_path))
+        if self.tracer != None:
+            self.tracer.udev(action, device)
+        self.received += 1
+        if not self.matches(device):
+            self.filtered += 1
+            return
         path = device.device_path
         if action == 'add' or action == 'change':
             self.dev_add_change(path, device)
@@ -45,15 +136,27 @@ class UDevMonitor:
 
     def dev_add_change(self, path, device):
         if path in self.devs:
-            dev = self.devs[path]
+            dev = self.devs.pop(path)
             dev.update(device)
         else:
             dev = UDevDevice(path)
             dev.added(device)
-            self.devs[path] = dev
+            if len(self.devs) >= self.max_devices:
+                old, _ = self.devs.popitem(last=False)
+                LOG.debug("evicting %s" % old)
+                self.evicted += 1
+        self.devs[path] = dev
 
     def dev_remove(self, path, device):
         if path in self.devs:
             dev = self.devs[path]
             dev.removed(device)
             del self.devs[path]
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "filtered": self.filtered,
+            "evicted": self.evicted,
+            "devices": len(self.devs),
+        }
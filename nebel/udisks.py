@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import time
 import logging
 
 from nebel.dbus import *
@@ -24,7 +25,82 @@ UDISKS_PATH_DRIVES = UDISKS_PATH + "/drives"
 OPERATION_FS_MOUNT = "filesystem-mount"
 OPERATION_FS_UNMOUNT = "filesystem-unmount"
 
+# operations we report, as (notification prefix, verb)
+JOB_OPERATIONS = {
+    OPERATION_FS_MOUNT: ("mount", "Mounting"),
+    OPERATION_FS_UNMOUNT: ("unmount", "Unmounting"),
+    "format-mkfs": ("format", "Formatting"),
+    "format-erase": ("format", "Erasing"),
+    "encrypted-unlock": ("unlock", "Unlocking"),
+    "encrypted-lock": ("lock", "Locking"),
+    "filesystem-check": ("check", "Checking"),
+    "filesystem-repair": ("check", "Repairing"),
+}
+
+# minimum interval between job progress updates in milliseconds
+JOB_PROGRESS_INTERVAL = 1000
+
+# coalescing window for drive notifications in milliseconds,
+# plugging a disk produces a burst of device updates
+DRIVE_NOTIFY_WINDOW = 250
+
+def object_paths(objs):
+    return tuple(map(str, objs))
+
+def format_rate(rate):
+    for unit in ("B/s", "kB/s", "MB/s", "GB/s"):
+        if rate < 1000:
+            break
+        rate = rate / 1000.0
+    return "%.1f %s" % (rate, unit)
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return "%d:%02d" % (seconds // 60, seconds % 60)
+
+def render_drive(vendor, model, removable, available, media):
+    message = "\nDrive  %s %s" % (vendor.strip(), model.strip())
+    if removable:
+        if available:
+            if media:
+                message = message + ("\nMedium %s" % media)
+        else:
+            message = message + "\nMedium none"
+    return message
+
+def render_device(device, encrypted, filesystem, partition, ptable):
+    lines = ["Device %s:\n" % device]
+    if encrypted:
+        lines.append("  encrypted\n")
+    if filesystem:
+        lines.append("  filesystem\n")
+    if partition:
+        lines.append("  partition\n")
+    if ptable:
+        lines.append("  partitioned\n")
+    return "".join(lines)
+
 class DiskDrive(DbusPropsObject):
+    PROPERTIES = {
+        UDISKS_DRIVE: (("ConnectionBus", str),
+                       ("Seat", str),
+                       ("Vendor", str),
+                       ("Model", str),
+                       ("Serial", str),
+                       ("Removable", bool),
+                       ("Ejectable", bool),
+                       ("Media", str),
+                       ("MediaAvailable", bool),
+                       ("MediaRemovable", bool),
+                       ("Size", int)),
+    }
+
+    SNAPSHOT = ()
+
+    SLOTS = ("monitor", "devices")
+
     def __init__(self, monitor, path):
         DbusPropsObject.__init__(self, UDISKS, path, [DBUS_PROPERTIES, UDISKS_DRIVE], log = LOG)
         self.monitor = monitor
@@ -35,16 +111,15 @@ class DiskDrive(DbusPropsObject):
         self.MediaAvailable = False
         self.MediaRemovable = False
 
+    # the signal carries all properties of the drive,
+    # so there is nothing to fetch
     def ifs_added(self, ifprops):
-        pass
+        if UDISKS_DRIVE in ifprops:
+            self.props_updated(self.apply_props(UDISKS_DRIVE, ifprops[UDISKS_DRIVE]))
 
     def ifs_removed(self, difprops):
         pass
 
-    def added(self):
-        DbusPropsObject.added(self)
-        self.notify_added()
-
     def removed(self):
         DbusPropsObject.removed(self)
         self.notify_removed()
@@ -62,6 +137,7 @@ class DiskDrive(DbusPropsObject):
         self.log.debug("drive %s: device removed %s" % (self.path, device.path))
         if device.path in self.devices:
             del self.devices[device.path]
+            self.unrender(device.path)
             self.notify_changed()
 
     def notify_added(self):
@@ -74,53 +150,47 @@ class DiskDrive(DbusPropsObject):
     def notify(self, summary):
         if not (self.Ejectable or self.Removable or self.MediaRemovable):
             return
-        message = "\nDrive  %s %s" % (self.Vendor.strip(), self.Model.strip())
-        if self.MediaRemovable:
-            if self.MediaAvailable:
-                if self.Media:
-                    message = message + ("\nMedium %s" % self.Media)
-            else:
-                message = message + "\nMedium none"
+        # only sections whose inputs changed are rendered again
+        parts = [self.render("drive", render_drive, self.Vendor, self.Model,
+                             self.MediaRemovable, self.MediaAvailable, self.Media)]
         if self.devices:
-            message = message + "\n"
+            parts.append("\n")
             for dev in self.devices.values():
-                message = message + ("Device %s:\n" % dev.Device)
-                if dev.is_encrypted:
-                    message = message + ("  encrypted\n")
-                if dev.is_filesystem:
-                    message = message + ("  filesystem\n")
-                if dev.is_partition:
-                    message = message + ("  partition\n")
-                if dev.is_ptable:
-                    message = message + ("  partitioned\n")
-
-        self.renotify("drive-%s" % self.path, summary, message=message, timeout=5000)
+                parts.append(self.render(dev.path, render_device, dev.Device,
+                                         dev.is_encrypted, dev.is_filesystem,
+                                         dev.is_partition, dev.is_ptable))
 
-    def update(self):
-        DbusPropsObject.update(self)
+        self.renotify("drive-%s" % self.path, summary, message="".join(parts), timeout=5000,
+                      window=DRIVE_NOTIFY_WINDOW)
+
+    def props_updated(self, changed):
+        DbusPropsObject.props_updated(self, changed)
         was_init = self.init
-        was_media  = self.Media
-        was_mavail = self.MediaAvailable
-        self.update_prop(UDISKS_DRIVE, "ConnectionBus", str)
-        self.update_prop(UDISKS_DRIVE, "Seat", str)
-        self.update_prop(UDISKS_DRIVE, "Vendor", str)
-        self.update_prop(UDISKS_DRIVE, "Model", str)
-        self.update_prop(UDISKS_DRIVE, "Serial", str)
-        self.update_prop(UDISKS_DRIVE, "Removable", bool)
-        self.update_prop(UDISKS_DRIVE, "Ejectable", bool)
-        self.update_prop(UDISKS_DRIVE, "Media", str)
-        self.update_prop(UDISKS_DRIVE, "MediaAvailable", bool)
-        self.update_prop(UDISKS_DRIVE, "MediaRemovable", bool)
-        self.update_prop(UDISKS_DRIVE, "Size", int)
         self.init = True
-        if was_init:
-            if was_media != self.Media or was_mavail != self.MediaAvailable:
+        if not was_init:
+            self.notify_added()
+        else:
+            if "Media" in changed or "MediaAvailable" in changed:
                 if self.MediaAvailable:
                     self.notify("Medium changed")
                 else:
                     self.notify("Medium removed")
 
 class DiskDevice(DbusPropsObject):
+    PROPERTIES = {
+        UDISKS_BLOCK: (("Device", str),
+                       ("Drive", str),
+                       ("ReadOnly", str),
+                       ("IdLabel", str),
+                       ("IdType", str),
+                       ("IdUsage", str),
+                       ("IdVersion", str)),
+        UDISKS_PARTITION_TABLE: (("Type", str),),
+    }
+
+    SLOTS = ("monitor", "drive", "is_block", "is_encrypted", "is_filesystem",
+             "is_partition", "is_ptable")
+
     def __init__(self, monitor, path):
         DbusPropsObject.__init__(self, UDISKS, path, [DBUS_PROPERTIES, UDISKS_BLOCK], log = LOG)
         self.drive = None
@@ -134,107 +204,198 @@ class DiskDevice(DbusPropsObject):
         self.Device = None
 
     def ifs_added(self, ifprops):
-        ifs = map(str, ifprops.keys())
+        self.set_ifs(ifprops.keys(), True)
+        # the signal carries all properties of the new interfaces
+        changed = dict()
+        for iface in ifprops:
+            if str(iface) in self.PROPERTIES:
+                changed.update(self.apply_props(str(iface), ifprops[iface]))
+        self.props_updated(changed)
+
+    def ifs_removed(self, difs):
+        self.set_ifs(difs, False)
+        if self.drive:
+            self.drive.device_update(self)
+
+    def set_ifs(self, ifs, present):
+        ifs = set(map(str, ifs))
         if UDISKS_BLOCK in ifs:
-            self.is_block = True
+            self.is_block = present
         if UDISKS_ENCRYPTED in ifs:
-            self.is_encrypted = True
+            self.is_encrypted = present
         if UDISKS_FILESYSTEM in ifs:
-            self.is_filesystem = True
+            self.is_filesystem = present
         if UDISKS_PARTITION in ifs:
-            self.is_partition = True
+            self.is_partition = present
         if UDISKS_PARTITION_TABLE in ifs:
-            self.is_ptable = True
-        self.update()
-
-    def ifs_removed(self, difprops):
-        pass
+            self.is_ptable = present
 
     def removed(self):
         DbusPropsObject.removed(self)
-        if self.drive:
-            self.drive.device_removed(self)
-            self.drive = None
+        self.monitor.device_unlink(self, self.Drive)
 
     def update(self):
         DbusPropsObject.update(self)
-        was_init = self.init
         if self.is_block:
-            self.update_prop(UDISKS_BLOCK, "Device", str)
-            self.update_prop(UDISKS_BLOCK, "Drive", str)
-            self.update_prop(UDISKS_BLOCK, "ReadOnly", str)
-            self.update_prop(UDISKS_BLOCK, "IdLabel", str)
-            self.update_prop(UDISKS_BLOCK, "IdType", str)
-            self.update_prop(UDISKS_BLOCK, "IdUsage", str)
-            self.update_prop(UDISKS_BLOCK, "IdVersion", str)
+            self.update_props(UDISKS_BLOCK)
         if self.is_ptable:
-            self.update_prop(UDISKS_PARTITION_TABLE, "Type", str)
-            self.TableType = self.Type
-
-        self.Type = None
+            self.update_props(UDISKS_PARTITION_TABLE)
 
+    def props_updated(self, changed):
+        DbusPropsObject.props_updated(self, changed)
         self.init = True
-        # try to find the drive
-        if not self.drive:
-            if self.Drive and self.Drive in self.monitor.drives:
-                self.drive = self.monitor.drives[self.Drive]
-                self.drive.device_added(self)
-        # and call it with updates
-        if self.drive:
+        if "Drive" in changed:
+            # move to the new drive
+            self.monitor.device_unlink(self, changed["Drive"])
+            self.monitor.device_link(self)
+        elif self.drive:
+            # and call it with updates
             self.drive.device_update(self)
 
-class DiskJob(DbusObject):
+class DiskJob(DbusPropsObject):
+    PROPERTIES = {
+        UDISKS_JOB: (("Operation", str),
+                     ("Objects", object_paths),
+                     ("Cancelable", bool),
+                     ("Progress", float),
+                     ("ProgressValid", bool),
+                     ("Bytes", int),
+                     ("Rate", int),
+                     ("StartTime", int),
+                     ("ExpectedEndTime", int)),
+    }
+
+    SLOTS = ("monitor", "sample", "sigcompleted")
+
     def __init__(self, monitor, path):
-        DbusObject.__init__(self, UDISKS, path, [DBUS_PROPERTIES, UDISKS_JOB], log = LOG)
+        DbusPropsObject.__init__(self, UDISKS, path, [DBUS_PROPERTIES, UDISKS_JOB], log = LOG)
         self.monitor = monitor
+        self.Operation = None
+        self.Objects = ()
+        self.Progress = 0.0
+        self.ProgressValid = False
+        self.Bytes = 0
+        self.Rate = 0
+        self.ExpectedEndTime = 0
+        self.sample = None
+        self.sigcompleted = None
 
-    def ifs_added(self, difprops):
-        ifprops = dict()
-        for key in difprops.keys():
-            ifprops[str(key)] = difprops[key]
-        djob = ifprops[UDISKS_JOB]
-        job = dict()
-        for key in djob.keys():
-            job[str(key)] = djob[key]
-        self.Operation = str(job["Operation"])
-        self.Cancelable = bool(job["Cancelable"])
-        self.ProgressValid = bool(job["ProgressValid"])
-        self.Progress = float(job["Progress"])
-        self.Objects = job["Objects"]
-        self.log.info("op %s objs %s" % (self.Operation, self.Objects))
-        self.sigcompleted = self.obj.connect_to_signal("Completed", self.completed)
-        if self.Operation == OPERATION_FS_MOUNT:
-            bpath = self.Objects[0]
-            self.renotify("mount-%s" % bpath, "Mounting %s..." % bpath, timeout=5000)
-        if self.Operation == OPERATION_FS_UNMOUNT:
-            bpath = self.Objects[0]
-            self.renotify("unmount-%s" % bpath, "Unmounting %s" % bpath, timeout=5000)
-
-    def ifs_removed(self, ifs):
+    def ifs_added(self, ifprops):
+        for iface in ifprops:
+            if str(iface) == UDISKS_JOB:
+                self.props_updated(self.apply_props(UDISKS_JOB, ifprops[iface]))
+
+    def ifs_removed(self, difs):
         pass
 
+    def removed(self):
+        DbusPropsObject.removed(self)
+        self.sigcompleted = None
+
+    def detach(self):
+        DbusPropsObject.detach(self)
+        self.sigcompleted = None
+
     def update(self):
         pass
 
+    def props_updated(self, changed):
+        DbusPropsObject.props_updated(self, changed)
+        was_init = self.init
+        self.init = True
+        if not was_init:
+            self.log.info("op %s objs %s" % (self.Operation, self.Objects))
+            self.sigcompleted = self.connect_signal(UDISKS_JOB, "Completed", self.completed)
+            self.notify("...", timeout=5000)
+        elif "Progress" in changed and self.ProgressValid:
+            self.notify_progress()
+
+    def notify(self, state, message='', timeout=1000, window=NOTIFY_WINDOW):
+        if not self.Operation in JOB_OPERATIONS or not self.Objects:
+            return
+        prefix, verb = JOB_OPERATIONS[self.Operation]
+        bpath = self.Objects[0]
+        self.renotify("%s-%s" % (prefix, bpath), "%s %s%s" % (verb, bpath, state),
+                      message=message, timeout=timeout, window=window)
+
+    def notify_progress(self):
+        now = time.time()
+        if self.sample == None:
+            self.sample = (now, self.Progress)
+        message = "%d%%" % (self.Progress * 100)
+        # prefer the rate and end time from udisks over our own estimate
+        rate = self.Rate
+        eta = None
+        if self.ExpectedEndTime:
+            eta = self.ExpectedEndTime / 1000000.0 - now
+        elapsed = now - self.sample[0]
+        done = self.Progress - self.sample[1]
+        if elapsed > 0 and done > 0:
+            if not rate and self.Bytes:
+                rate = done * self.Bytes / elapsed
+            if eta == None:
+                eta = (1.0 - self.Progress) * elapsed / done
+        if rate:
+            message = message + (", %s" % format_rate(rate))
+        if eta != None and eta > 0:
+            message = message + (", %s left" % format_duration(eta))
+        self.notify("...", message=message, timeout=5000, window=JOB_PROGRESS_INTERVAL)
+
     def completed(self, success, message):
         self.log.info("%s: completed sucess %s message %s" % (self.path, success, message))
-        if self.Operation == OPERATION_FS_MOUNT:
-            bpath = self.Objects[0]
-            self.renotify("mount-%s" % bpath, "Mounting %s...done." % bpath, timeout=1000)
-        if self.Operation == OPERATION_FS_UNMOUNT:
-            bpath = self.Objects[0]
-            self.renotify("unmount-%s" % bpath, "Unmounting %s...done." % bpath, timeout=1000)
+        if success:
+            self.notify("...done.")
+        else:
+            self.notify("...failed.", message=str(message), timeout=5000)
 
 class DiskMonitor(DbusObjectManager):
+    SLOTS = ("devices", "drives", "jobs", "pending")
+
     def __init__(self):
         DbusObjectManager.__init__(self, UDISKS, UDISKS_PATH, [UDISKS], log = LOG)
         self.devices = dict()
         self.drives = dict()
         self.jobs = dict()
+        # devices waiting for their drive, by drive path
+        self.pending = dict()
         self.added()
 
+    def detach(self):
+        DbusObjectManager.detach(self)
+        self.devices = dict()
+        self.drives = dict()
+        self.jobs = dict()
+        self.pending = dict()
+
+    def stats(self):
+        return {
+            "devices": len(self.devices),
+            "drives": len(self.drives),
+            "jobs": len(self.jobs),
+            "pending": sum(len(devices) for devices in self.pending.values()),
+        }
+
+    def device_link(self, device):
+        path = device.Drive
+        if not path or path == "/":
+            return
+        if path in self.drives:
+            device.drive = self.drives[path]
+            device.drive.device_added(device)
+        else:
+            self.pending.setdefault(path, dict())[device.path] = device
+
+    def device_unlink(self, device, path):
+        if path in self.pending:
+            self.pending[path].pop(device.path, None)
+            if not self.pending[path]:
+                del self.pending[path]
+        if device.drive:
+            device.drive.device_removed(device)
+            device.drive = None
+
     def obj_instantiate(self, path, ifprops):
-        ifs = map(str, ifprops.keys())
+        ifs = list(map(str, ifprops.keys()))
         name = str(path)
         objnew = False
         object = None
@@ -256,26 +417,34 @@ class DiskMonitor(DbusObjectManager):
                 objnew = True
                 self.drives[name] = DiskDrive(self, path)
             object = self.drives[name]
-            # force drive detect
-            for device in self.devices.values():
-                device.update()
+            # link the devices that were waiting for it
+            for device in self.pending.pop(name, dict()).values():
+                device.drive = object
+                object.device_added(device)
         if object == None:
             self.log.warning("unclassified object %s ifaces %s" % (name, ifs))
         return object
 
+    # drives removed while we were down are reported as if we
+    # had seen them go
+    def objs_vanished(self, states):
+        for path, state in states.items():
+            if path.startswith(UDISKS_PATH_DRIVES + "/"):
+                self.log.info("vanished %s" % path)
+                drive = DiskDrive(self, path)
+                drive.restore(state)
+                drive.notify_removed()
+
+    # called once the object lost all of its interfaces
     def obj_destroy(self, obj, difs):
-        ifs = map(str, difs)
         name = str(obj.path)
-        object = None
-        if UDISKS_JOB in ifs:
-            if name in self.jobs:
-                object = self.jobs[name]
-                del self.jobs[name]
-        if UDISKS_BLOCK in ifs:
-            if name in self.devices:
-                object = self.devices[name]
-                del self.devices[name]
-        if UDISKS_DRIVE in ifs:
-            if name in self.drives:
-                object = self.drives[name]
-                del self.drives[name]
+        if self.jobs.get(name) is obj:
+            del self.jobs[name]
+        if self.devices.get(name) is obj:
+            del self.devices[name]
+        if self.drives.get(name) is obj:
+            del self.drives[name]
+            # devices wait for the drive to come back
+            for device in obj.devices.values():
+                device.drive = None
+                self.pending.setdefault(name, dict())[device.path] = device
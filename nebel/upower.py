@@ -3,18 +3,23 @@ from __future__ import absolute_import
 import math
 import logging
 
-import glib
-
 from enum import Enum
 
+from nebel import engine
+from nebel.engine import clock
 from nebel.dbus import *
+from nebel.instrument import instrument
 
 LOG = logging.getLogger("nebel.upower")
 
-# polling interval for batteries
+# polling interval for batteries when the rate is unknown
 # ensures that we are a bit more timely than upower
 BATTERY_POLL_INTERVAL = 30
 
+# bounds for adaptive battery polling in seconds
+BATTERY_POLL_MIN = 10
+BATTERY_POLL_MAX = 600
+
 UPOWER = "org.freedesktop.UPower"
 UPOWER_DEVICE = "org.freedesktop.UPower.Device"
 
@@ -64,9 +69,99 @@ class DeviceState(Enum):
     pending_charge = 5
     pending_discharge = 6
 
+STATE_MESSAGES = {
+    DeviceState.charged: "%s is fully charged",
+    DeviceState.empty: "%s is empty",
+}
+
+def render_state(name, state):
+    return STATE_MESSAGES[state] % name
+
+def render_level(name, percent):
+    return "%s now at %d%%" % (name, percent)
+
+# polls all batteries from a single timer
+#
+# Each battery is due when one of its notification limits
+# could have been crossed at the current rate. Batteries
+# that are neither charging nor discharging are not polled.
+class BatteryPoller:
+    def __init__(self):
+        self.batteries = dict()
+        self.timer = None
+        self.deadline = None
+
+    def add(self, dev):
+        self.batteries[dev.path] = dev
+        self.schedule(dev)
+
+    def remove(self, dev):
+        if self.batteries.pop(dev.path, None) != None:
+            self.reschedule()
+
+    def schedule(self, dev):
+        delay = dev.poll_delay()
+        if delay == None:
+            dev.due = None
+        else:
+            dev.due = clock() + delay
+            LOG.debug("%s: next poll in %ds" % (dev.NativePath, delay))
+        self.reschedule()
+
+    def reschedule(self):
+        deadline = None
+        for dev in self.batteries.values():
+            if dev.due != None and (deadline == None or dev.due < deadline):
+                deadline = dev.due
+        if deadline == self.deadline:
+            return
+        if self.timer != None:
+            engine.source_remove(self.timer)
+            self.timer = None
+        self.deadline = deadline
+        if deadline != None:
+            delay = max(deadline - clock(), 0)
+            self.timer = engine.timeout_add(int(delay * 1000), instrument.run,
+                                            ("timer", "BatteryPoller.tick"), None, self.tick)
+
+    # a poll failed, try again later
+    def retry(self, dev):
+        if self.batteries.get(dev.path) is dev:
+            dev.due = clock() + BATTERY_POLL_INTERVAL
+            self.reschedule()
+
+    def tick(self):
+        self.timer = None
+        self.deadline = None
+        now = clock()
+        for dev in list(self.batteries.values()):
+            if dev.due != None and dev.due <= now:
+                # polled again once its properties arrive
+                dev.due = None
+                dev.update()
+        self.reschedule()
+        return False
+
 class PowerDevice(DbusPropsObject):
-    def __init__(self, path):
+    PROPERTIES = {
+        UPOWER_DEVICE: (("Type", DeviceType),
+                        ("PowerSupply", bool),
+                        ("State", DeviceState),
+                        ("Online", bool),
+                        ("TimeToEmpty", int),
+                        ("TimeToFull", int),
+                        ("Percentage", float),
+                        ("NativePath", str)),
+    }
+
+    SNAPSHOT = ("ChargeSeen", "DischargeSeen")
+
+    SLOTS = ("monitor", "due", "PercentageSeen")
+
+    def __init__(self, monitor, path):
         DbusPropsObject.__init__(self, UPOWER, path, [UPOWER_DEVICE], log = LOG)
+        self.monitor = monitor
+        self.due = None
         self.Type = DeviceType.unknown
         self.PowerSupply = False
         self.State = DeviceState.unknown
@@ -76,33 +171,46 @@ class PowerDevice(DbusPropsObject):
         self.Percentage = 0.0
         self.PercentageSeen = None
 
-    def added(self):
-        DbusPropsObject.added(self)
-        if self.Type == DeviceType.battery:
-            self.timer = glib.timeout_add(BATTERY_POLL_INTERVAL * 1000, self.tick)
-
     def removed(self):
         DbusPropsObject.removed(self)
-
-    def tick(self):
-        self.update()
-        return True
+        self.monitor.poller.remove(self)
+
+    def detach(self):
+        DbusPropsObject.detach(self)
+        self.monitor.poller.remove(self)
+
+    # seconds until a notification limit could be crossed,
+    # None if there is nothing to wait for
+    def poll_delay(self):
+        percent = self.Percentage
+        if self.State == DeviceState.discharging:
+            if self.TimeToEmpty <= 0:
+                return BATTERY_POLL_INTERVAL
+            rate = percent / self.TimeToEmpty
+            limit = discharge_notify_limit(percent, self.DischargeSeen)
+            distance = percent - limit
+        elif self.State == DeviceState.charging:
+            if self.TimeToFull <= 0:
+                return BATTERY_POLL_INTERVAL
+            rate = (100.0 - percent) / self.TimeToFull
+            limit = charge_notify_limit(percent, self.ChargeSeen)
+            distance = min(limit - percent, 100.0 - percent)
+        else:
+            return None
+        if rate <= 0:
+            return BATTERY_POLL_MAX
+        return min(max(distance / rate, BATTERY_POLL_MIN), BATTERY_POLL_MAX)
 
     def update(self):
         DbusPropsObject.update(self)
+        self.update_props(UPOWER_DEVICE, self.update_failed)
+
+    def update_failed(self, err):
+        self.monitor.poller.retry(self)
+
+    def props_updated(self, changed):
+        DbusPropsObject.props_updated(self, changed)
         was_init = self.init
-        was_state = self.State
-        was_percent = self.Percentage
-        was_timetoe = self.TimeToEmpty
-        was_timetof = self.TimeToFull
-        self.update_prop(UPOWER_DEVICE, "Type", DeviceType)
-        self.update_prop(UPOWER_DEVICE, "PowerSupply", bool)
-        self.update_prop(UPOWER_DEVICE, "State", DeviceState)
-        self.update_prop(UPOWER_DEVICE, "Online", bool)
-        self.update_prop(UPOWER_DEVICE, "TimeToEmpty", int)
-        self.update_prop(UPOWER_DEVICE, "TimeToFull", int)
-        self.update_prop(UPOWER_DEVICE, "Percentage", float)
-        self.update_prop(UPOWER_DEVICE, "NativePath", str)
         is_state = self.State
         is_percent = self.Percentage
 
@@ -112,17 +220,21 @@ class PowerDevice(DbusPropsObject):
                 self.DischargeSeen = is_percent
 
         if was_init:
-            if is_state != was_state:
-                self.notify_state(is_state, was_state)
+            if "State" in changed:
+                self.notify_state(is_state, changed["State"])
 
             if self.Type == DeviceType.battery:
-                if is_state == DeviceState.charging:
-                    self.notify_charge(is_percent)
-                if is_state == DeviceState.discharging:
-                    self.notify_discharge(is_percent)
+                if "State" in changed or "Percentage" in changed:
+                    if is_state == DeviceState.charging:
+                        self.notify_charge(is_percent)
+                    if is_state == DeviceState.discharging:
+                        self.notify_discharge(is_percent)
 
         self.init = True
 
+        if self.Type == DeviceType.battery:
+            self.monitor.poller.add(self)
+
     def notify_state(self, new, old):
         LOG.info("%s: state now %s was %s" % (self.NativePath, new.name, old.name))
         if self.Type == DeviceType.battery:
@@ -134,11 +246,11 @@ class PowerDevice(DbusPropsObject):
                 self.DischargeSeen = self.Percentage
             if old == DeviceState.charging and new == DeviceState.charged:
                 # report full charge
-                self.renotify("state", "%s is fully charged" % self.NativePath,
+                self.renotify("state", self.render("state", render_state, self.NativePath, new),
                               urgency=notify.URGENCY_NORMAL, timeout=5000)
             if new == DeviceState.empty:
                 # report empty batteries
-                self.renotify("%s is empty" % self.NativePath,
+                self.renotify("state", self.render("state", render_state, self.NativePath, new),
                               urgency=notify.URGENCY_NORMAL, timeout=5000)
 
     def notify_charge(self, percent):
@@ -147,7 +259,7 @@ class PowerDevice(DbusPropsObject):
         LOG.info("%s: charging: %s%% seen %s%% limit %s%%"
                  % (self.NativePath, percent, seen, limit))
         if percent > limit:
-            self.renotify("progress", "%s now at %d%%" % (self.NativePath, percent),
+            self.renotify("progress", self.render("progress", render_level, self.NativePath, int(percent)),
                           urgency=notify.URGENCY_NORMAL, timeout=2000)
             self.ChargeSeen = percent
 
@@ -159,33 +271,45 @@ class PowerDevice(DbusPropsObject):
         if percent < limit:
             urgency = discharge_notify_urgency(percent)
             timeout = discharge_notify_timeout(percent)
-            self.renotify("progress", "%s now at %d%%" % (self.NativePath, percent),
+            self.renotify("progress", self.render("progress", render_level, self.NativePath, int(percent)),
                           urgency=urgency, timeout=timeout)
             self.DischargeSeen = percent
 
 
 class PowerMonitor(DbusPropsObject):
+    PROPERTIES = {
+        UPOWER: (("OnBattery", bool),),
+    }
+
+    SNAPSHOT = ()
+
+    SLOTS = ("batteries", "devs", "poller", "sigadd", "sigdel")
+
     def __init__(self):
         DbusPropsObject.__init__(self, UPOWER, UPOWER_PATH, [UPOWER], log = LOG)
         self.batteries = list()
         self.OnBattery = False
         self.devs = dict()
+        self.poller = BatteryPoller()
         self.added()
 
     def added(self):
+        self.subscribe()
         DbusPropsObject.added(self)
         self.enumerate()
-        self.sigadd = self.obj.connect_to_signal("DeviceAdded", self.dev_added)
-        self.sigdel = self.obj.connect_to_signal("DeviceRemoved", self.dev_removed)
+        self.sigadd = self.connect_signal(UPOWER, "DeviceAdded", self.dev_added)
+        self.sigdel = self.connect_signal(UPOWER, "DeviceRemoved", self.dev_removed)
 
     def update(self):
         DbusPropsObject.update(self)
+        self.update_props(UPOWER)
+
+    def props_updated(self, changed):
+        DbusPropsObject.props_updated(self, changed)
         was_init = self.init
-        was_onbat = self.OnBattery
-        self.update_prop(UPOWER, "OnBattery", bool)
         is_onbat = self.OnBattery
         if was_init:
-            if was_onbat != is_onbat:
+            if "OnBattery" in changed:
                 if is_onbat:
                     self.renotify("on-battery", "Now on battery power",
                                   urgency=notify.URGENCY_NORMAL, timeout=2000)
@@ -200,16 +324,32 @@ class PowerMonitor(DbusPropsObject):
         self.sigdel.remove()
         self.sigdel = None
         DbusPropsObject.removed(self)
+        self.unsubscribe()
+
+    def detach(self):
+        for dev in self.devs.values():
+            dev.detach()
+        self.devs = dict()
+        self.unsubscribe()
+        DbusPropsObject.detach(self)
+
+    def stats(self):
+        return {
+            "devices": len(self.devs),
+            "batteries": len(self.poller.batteries),
+        }
 
     def enumerate(self):
-        devs = self.obj.EnumerateDevices(dbus_interface=UPOWER)
+        self.call(UPOWER, "EnumerateDevices", "", (), self.enumerated)
+
+    def enumerated(self, devs):
         for dev in devs:
             self.dev_added(dev)
 
     def dev_added(self, path):
         name = str(path)
         if not name in self.devs:
-            self.devs[name] = PowerDevice(path)
+            self.devs[name] = PowerDevice(self, path)
             self.devs[name].added()
 
     def dev_removed(self, path):
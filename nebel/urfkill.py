@@ -11,7 +11,20 @@ URFKILL_DEVICE = "org.freedesktop.URfkill.Device"
 
 URFKILL_PATH = "/org/freedesktop/URfkill"
 
+def render_radio(name, blocked):
+    if blocked:
+        return "Blocked radio %s" % name
+    return "Unblocked radio %s" % name
+
 class RfkillDevice(DbusPropsObject):
+    PROPERTIES = {
+        URFKILL_DEVICE: (("name", str),
+                         ("soft", bool),
+                         ("hard", bool)),
+    }
+
+    SNAPSHOT = ("blocked",)
+
     def __init__(self, path):
         DbusPropsObject.__init__(self, URFKILL, path, [URFKILL_DEVICE], log = LOG)
         self.name = "<unknown>"
@@ -21,33 +34,34 @@ class RfkillDevice(DbusPropsObject):
 
     def update(self):
         DbusPropsObject.update(self)
+        self.update_props(URFKILL_DEVICE)
+
+    def props_updated(self, changed):
+        DbusPropsObject.props_updated(self, changed)
         was_init = self.init
         was_blocked = self.blocked
-        self.update_prop(URFKILL_DEVICE, "name", str)
-        self.update_prop(URFKILL_DEVICE, "soft", bool)
-        self.update_prop(URFKILL_DEVICE, "hard", bool)
         self.blocked = self.hard or self.soft
         is_blocked = self.blocked
         if was_init:
             if was_blocked != is_blocked:
-                if is_blocked:
-                    self.renotify("state", "Blocked radio %s" % self.name)
-                else:
-                    self.renotify("state", "Unblocked radio %s" % self.name)
+                self.renotify("state", self.render("state", render_radio, self.name, is_blocked))
         self.init = True
 
 class RfkillMonitor(DbusPropsObject):
+    SLOTS = ("devs", "sigadd", "sigchg", "sigdel")
+
     def __init__(self):
         DbusPropsObject.__init__(self, URFKILL, URFKILL_PATH, [URFKILL], log = LOG)
         self.devs = dict()
         self.added()
 
     def added(self):
+        self.subscribe()
         DbusPropsObject.added(self)
         self.enumerate()
-        self.sigadd = self.obj.connect_to_signal("DeviceAdded", self.dev_added_changed)
-        self.sigchg = self.obj.connect_to_signal("DeviceChanged", self.dev_added_changed)
-        self.sigdel = self.obj.connect_to_signal("DeviceRemoved", self.dev_removed)
+        self.sigadd = self.connect_signal(URFKILL, "DeviceAdded", self.dev_added_changed)
+        self.sigchg = self.connect_signal(URFKILL, "DeviceChanged", self.dev_added_changed)
+        self.sigdel = self.connect_signal(URFKILL, "DeviceRemoved", self.dev_removed)
 
     def removed(self):
         self.sigadd.remove()
@@ -57,9 +71,24 @@ class RfkillMonitor(DbusPropsObject):
         self.sigdel.remove()
         self.sigdel = None
         DbusPropsObject.removed(self)
+        self.unsubscribe()
+
+    def detach(self):
+        for dev in self.devs.values():
+            dev.detach()
+        self.devs = dict()
+        self.unsubscribe()
+        DbusPropsObject.detach(self)
+
+    def stats(self):
+        return {
+            "devices": len(self.devs),
+        }
 
     def enumerate(self):
-        devs = self.obj.EnumerateDevices(dbus_interface=URFKILL)
+        self.call(URFKILL, "EnumerateDevices", "", (), self.enumerated)
+
+    def enumerated(self, devs):
         for dev in devs:
             self.dev_added_changed(dev)
 
@@ -67,9 +96,11 @@ class RfkillMonitor(DbusPropsObject):
         name = str(path)
         if not name in self.devs:
             self.devs[name] = RfkillDevice(path)
-        self.devs[name].update()
+            self.devs[name].added()
+        else:
+            self.devs[name].update()
 
     def dev_removed(self, path):
         name = str(path)
         if name in self.devs:
-            del self.devs[name]
+            self.devs.pop(name).removed()
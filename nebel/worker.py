@@ -0,0 +1,282 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import logging
+import subprocess
+
+from nebel import engine
+from nebel.engine import clock
+from nebel.notifier import notifier
+
+LOG = logging.getLogger("nebel.worker")
+
+# monitors that can run in a worker of their own
+WORKERS = ("udisks", "power", "rfkill", "udev")
+
+# delay before restarting a worker that exited in milliseconds,
+# doubled for every exit in a row up to the maximum
+WORKER_RESTART_DELAY = 1000
+WORKER_MAX_RESTART_DELAY = 60000
+
+# a worker running this long in seconds starts over with
+# the shortest restart delay
+WORKER_STABLE = 60.0
+
+# time for workers to exit on shutdown in seconds
+WORKER_STOP_TIMEOUT = 2.0
+
+# number of objects the front-end keeps track of
+# beyond those with notifications
+FRONTEND_MAX_OWNERS = 256
+
+# closes all descriptors but stdio and keep,
+# in a new process before it runs the worker
+def close_fds_except(keep):
+    try:
+        limit = os.sysconf("SC_OPEN_MAX")
+    except (ValueError, OSError):
+        limit = 1024
+    os.closerange(3, keep)
+    os.closerange(keep + 1, limit)
+
+def encode(record):
+    return (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+
+# passes the notifications of a worker to the front-end
+#
+# One JSON array per line:
+#
+#   ["s", path, name, summary, message, timeout, urgency, window]
+#   ["c", path, name]
+#
+# The front-end never writes, the socket closing means it
+# is gone and done is called.
+class WorkerLink(object):
+    def __init__(self, sock, done=None):
+        self.sock = sock
+        self.done = done
+        self.watch = engine.io_add_watch(sock.fileno(),
+                                         engine.IO_IN | engine.IO_HUP | engine.IO_ERR,
+                                         self.hangup)
+
+    def send(self, record):
+        if self.sock == None:
+            return
+        try:
+            self.sock.sendall(encode(record))
+        except socket.error as e:
+            LOG.warning("lost the front-end: %s" % e)
+            self.close()
+
+    def show(self, path, name, summary, message, timeout, urgency, window):
+        self.send(["s", path, name, summary, message, timeout, urgency, window])
+
+    def cancel(self, path, name):
+        self.send(["c", path, name])
+
+    def hangup(self, fd, condition):
+        LOG.info("front-end went away")
+        self.watch = None
+        self.close()
+        return False
+
+    def close(self):
+        if self.watch != None:
+            engine.source_remove(self.watch)
+            self.watch = None
+        if self.sock != None:
+            self.sock.close()
+            self.sock = None
+            if self.done != None:
+                self.done()
+
+# stands in for the objects of a worker in the front-end
+class RemoteOwner(object):
+    __slots__ = ("path", "notifs")
+
+    def __init__(self, path):
+        self.path = path
+        self.notifs = dict()
+
+# a monitor in a process of its own
+#
+# The process is started from argv with the worker name and
+# its end of a socketpair appended. Once the socket closes
+# the process is reaped and started again after a delay.
+class Worker(object):
+    def __init__(self, supervisor, name):
+        self.supervisor = supervisor
+        self.name = name
+        self.process = None
+        self.sock = None
+        self.watch = None
+        self.buffer = b""
+        self.started = None
+        self.delay = WORKER_RESTART_DELAY
+        self.timer = None
+        self.restarts = 0
+
+    def start(self):
+        self.timer = None
+        front, back = socket.socketpair()
+        fd = back.fileno()
+        argv = self.supervisor.argv + ["--worker", self.name, "--worker-fd", str(fd)]
+        # the worker only gets its own end, the ends of other
+        # workers would keep them from seeing us go away
+        if sys.version_info[0] >= 3:
+            options = {"pass_fds": (fd,)}
+        else:
+            options = {"close_fds": False, "preexec_fn": lambda: close_fds_except(fd)}
+        try:
+            self.process = subprocess.Popen(argv, **options)
+        except OSError as e:
+            LOG.warning("can not start worker %s: %s" % (self.name, e))
+            front.close()
+            back.close()
+            self.schedule()
+            return False
+        back.close()
+        front.setblocking(False)
+        self.sock = front
+        self.buffer = b""
+        self.started = clock()
+        self.watch = engine.io_add_watch(front.fileno(),
+                                         engine.IO_IN | engine.IO_HUP | engine.IO_ERR,
+                                         self.readable)
+        LOG.info("started worker %s as %d" % (self.name, self.process.pid))
+        return False
+
+    def readable(self, fd, condition):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            data = b""
+        if not data:
+            self.watch = None
+            self.exited()
+            return False
+        lines = (self.buffer + data).split(b"\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            self.supervisor.dispatch(self, line)
+        return True
+
+    def exited(self):
+        self.sock.close()
+        self.sock = None
+        code = self.process.wait()
+        self.process = None
+        if self.supervisor.stopping:
+            return
+        if clock() - self.started >= WORKER_STABLE:
+            self.delay = WORKER_RESTART_DELAY
+        LOG.warning("worker %s exited with %d, restarting in %d ms"
+                    % (self.name, code, self.delay))
+        self.restarts += 1
+        self.schedule()
+
+    def schedule(self):
+        self.timer = engine.timeout_add(self.delay, self.start)
+        self.delay = min(self.delay * 2, WORKER_MAX_RESTART_DELAY)
+
+    # closes the socket, the worker exits once it notices
+    def stop(self):
+        if self.timer != None:
+            engine.source_remove(self.timer)
+            self.timer = None
+        if self.watch != None:
+            engine.source_remove(self.watch)
+            self.watch = None
+        if self.sock != None:
+            self.sock.close()
+            self.sock = None
+
+    def reap(self, deadline):
+        if self.process == None:
+            return
+        while self.process.poll() == None and clock() < deadline:
+            time.sleep(0.05)
+        if self.process.poll() == None:
+            LOG.warning("killing worker %s" % self.name)
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+# runs monitors in workers and shows their notifications
+#
+# Notifications from all workers go through the notifier of
+# the front-end, so coalescing and rate limits apply to all
+# of them together and a monitor that is stuck or crashing
+# does not hold up the others.
+class Supervisor(object):
+    def __init__(self, names=WORKERS, argv=None):
+        if argv == None:
+            argv = [sys.executable] + sys.argv
+        self.argv = argv
+        self.workers = [Worker(self, name) for name in names]
+        self.owners = dict()
+        self.stopping = False
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            worker.stop()
+        deadline = clock() + WORKER_STOP_TIMEOUT
+        for worker in self.workers:
+            worker.reap(deadline)
+
+    def owner(self, path):
+        owner = self.owners.get(path)
+        if owner == None:
+            if len(self.owners) >= FRONTEND_MAX_OWNERS:
+                self.prune()
+            owner = self.owners[path] = RemoteOwner(path)
+        return owner
+
+    # forgets objects without notifications
+    def prune(self):
+        pending = set(key[0] for key in notifier.pending)
+        for path in list(self.owners.keys()):
+            if not self.owners[path].notifs and not path in pending:
+                del self.owners[path]
+
+    def dispatch(self, worker, line):
+        try:
+            record = json.loads(line.decode("utf-8"))
+            kind = record[0]
+            args = record[1:]
+        except (ValueError, IndexError, TypeError):
+            LOG.warning("broken record from worker %s: %r" % (worker.name, line))
+            return
+        if kind == "s" and len(args) == 7:
+            path, name, summary, message, timeout, urgency, window = args
+            notifier.show(self.owner(path), name, summary, message,
+                          timeout, urgency, window)
+        elif kind == "c" and len(args) == 2:
+            path, name = args
+            if path in self.owners:
+                notifier.cancel(self.owners[path], name)
+        else:
+            LOG.warning("unknown record from worker %s: %r" % (worker.name, line))
+
+    def stats(self):
+        return dict((worker.name, worker.restarts) for worker in self.workers)
+
+# connects a worker to the front-end from the descriptor it was given
+def attach(fd, done=None):
+    sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(fd)
+    link = WorkerLink(sock, done)
+    notifier.forward = link
+    return link
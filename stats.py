@@ -0,0 +1,20 @@
+import sys
+import argparse
+import dbus
+from nebel.stats import STATS, STATS_PATH, sample_name
+
+parser = argparse.ArgumentParser(description="Print the counters of a running nebel")
+parser.add_argument("--prometheus", action="store_true",
+                    help="print them in the Prometheus text format")
+args = parser.parse_args()
+
+try:
+    stats = dbus.Interface(dbus.SessionBus().get_object(STATS, STATS_PATH, introspect=False), STATS)
+    if args.prometheus:
+        sys.stdout.write(stats.GetMetrics())
+    else:
+        for metric, labels, value in sorted(stats.GetStats(), key=lambda s: (s[0], sorted(s[1].items()))):
+            print("%s %g" % (sample_name(metric, labels), value))
+except dbus.exceptions.DBusException as e:
+    sys.stderr.write("can not get stats from %s: %s\n" % (STATS, e.get_dbus_message()))
+    sys.exit(1)